@@ -0,0 +1,21 @@
+"""
+nvJPEG decoding helpers shared by the LexiGraph trainers.
+
+Datasets return the raw file bytes from `read_jpeg_bytes`; the collated batch of bytes is
+decoded on the GPU with `decode_jpeg_batch`, so only compressed data crosses the PCIe bus.
+Batched GPU decoding needs torchvision >= 0.19.
+"""
+
+import torch
+from torchvision.io import ImageReadMode, decode_jpeg, read_file
+
+
+def read_jpeg_bytes(path):
+    """Read an image file into a uint8 numpy array of its raw bytes."""
+    return read_file(str(path)).numpy()
+
+
+def decode_jpeg_batch(jpeg_bytes, transform, device):
+    """Decode a list of raw JPEG byte arrays on `device`, apply `transform` to each image and stack them."""
+    images = decode_jpeg([torch.from_numpy(data) for data in jpeg_bytes], mode=ImageReadMode.RGB, device=device)
+    return torch.stack([transform(image) for image in images])
@@ -11,11 +11,14 @@ Usage:
 """
 
 import argparse
+import collections
+import functools
 import logging
 import math
 import os
-import random
 import shutil
+import threading
+import uuid
 from pathlib import Path
 from typing import Optional
 
@@ -25,7 +28,7 @@ import torch.nn.functional as F
 import torch.utils.checkpoint
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import ProjectConfiguration, set_seed
+from accelerate.utils import DataLoaderConfiguration, DistributedDataParallelKwargs, ProjectConfiguration, set_seed
 from diffusers import (
     AutoencoderKL,
     DDPMScheduler,
@@ -34,18 +37,23 @@ from diffusers import (
     StableDiffusionPipeline,
     UNet2DConditionModel,
 )
+from diffusers.models.attention import BasicTransformerBlock
 from diffusers.optimization import get_scheduler
 from diffusers.training_utils import EMAModel
 from diffusers.utils import check_min_version, is_wandb_available
 from diffusers.utils.import_utils import is_xformers_available
+from diffusers.utils.torch_utils import is_compiled_module
 from huggingface_hub import create_repo, upload_folder
 from omegaconf import OmegaConf
+from packaging import version
 from PIL import Image
 from torch.utils.data import Dataset
 from torchvision import transforms
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
 
+from gpu_decode import decode_jpeg_batch, read_jpeg_bytes
+
 # Configure logging
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -71,17 +79,20 @@ class DreamBoothDataset(Dataset):
         size=512,
         center_crop=False,
         color_jitter=False,
+        gpu_decode=False,
     ):
         self.size = size
         self.center_crop = center_crop
         self.tokenizer = tokenizer
         self.color_jitter = color_jitter
+        self.gpu_decode = gpu_decode
 
         self.instance_data_root = Path(instance_data_root)
         if not self.instance_data_root.exists():
             raise ValueError("Instance images root doesn't exist.")
 
-        self.instance_images_path = list(Path(instance_data_root).iterdir())
+        # Plain string paths in a numpy array are far lighter than a list of Path objects
+        self.instance_images_path = np.array([str(p) for p in Path(instance_data_root).iterdir()])
         self.num_instance_images = len(self.instance_images_path)
         self.instance_prompt = instance_prompt
         self._length = self.num_instance_images
@@ -89,7 +100,7 @@ class DreamBoothDataset(Dataset):
         if class_data_root is not None:
             self.class_data_root = Path(class_data_root)
             self.class_data_root.mkdir(parents=True, exist_ok=True)
-            self.class_images_path = list(self.class_data_root.iterdir())
+            self.class_images_path = np.array([str(p) for p in self.class_data_root.iterdir()])
             if class_num is not None:
                 self.num_class_images = min(len(self.class_images_path), class_num)
             else:
@@ -104,19 +115,44 @@ class DreamBoothDataset(Dataset):
                 transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR),
                 transforms.CenterCrop(size) if center_crop else transforms.RandomCrop(size),
                 transforms.ColorJitter(0.1, 0.1) if color_jitter else transforms.Lambda(lambda x: x),
-                transforms.ToTensor(),
-                transforms.Normalize([0.5], [0.5]),
+                # Images stay uint8 until they reach the GPU, see normalize_pixel_values
+                transforms.PILToTensor(),
+            ]
+        )
+
+        # Same augmentations applied to decoded uint8 tensors on the GPU
+        self.tensor_transforms = transforms.Compose(
+            [
+                transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR, antialias=True),
+                transforms.CenterCrop(size) if center_crop else transforms.RandomCrop(size),
+                transforms.ColorJitter(0.1, 0.1) if color_jitter else transforms.Lambda(lambda x: x),
             ]
         )
 
+        # Memory-mapped VAE latent distributions (mean and logvar), attached by the trainer when latent caching is enabled
+        self.instance_latents = None
+        self.class_latents = None
+
     def __len__(self):
         return self._length
 
+    def load_image(self, image_path):
+        """Load an image from disk and apply the training transforms."""
+        image = Image.open(image_path).convert("RGB")
+        return self.image_transforms(image)
+
+    def decode_images(self, jpeg_bytes, device):
+        """Decode a batch of raw JPEG bytes with nvJPEG on `device` and apply the training transforms."""
+        return decode_jpeg_batch(jpeg_bytes, self.tensor_transforms, device)
+
     def __getitem__(self, index):
         example = {}
-        instance_image = Image.open(self.instance_images_path[index % self.num_instance_images])
-        instance_image = instance_image.convert("RGB")
-        example["instance_images"] = self.image_transforms(instance_image)
+        if self.instance_latents is not None:
+            example["instance_latents"] = torch.from_numpy(np.array(self.instance_latents[index % self.num_instance_images]))
+        elif self.gpu_decode:
+            example["instance_jpeg"] = read_jpeg_bytes(self.instance_images_path[index % self.num_instance_images])
+        else:
+            example["instance_images"] = self.load_image(self.instance_images_path[index % self.num_instance_images])
         example["instance_prompt_ids"] = self.tokenizer(
             self.instance_prompt,
             truncation=True,
@@ -126,9 +162,12 @@ class DreamBoothDataset(Dataset):
         ).input_ids
 
         if self.class_data_root:
-            class_image = Image.open(self.class_images_path[index % self.num_class_images])
-            class_image = class_image.convert("RGB")
-            example["class_images"] = self.image_transforms(class_image)
+            if self.class_latents is not None:
+                example["class_latents"] = torch.from_numpy(np.array(self.class_latents[index % self.num_class_images]))
+            elif self.gpu_decode:
+                example["class_jpeg"] = read_jpeg_bytes(self.class_images_path[index % self.num_class_images])
+            else:
+                example["class_images"] = self.load_image(self.class_images_path[index % self.num_class_images])
             example["class_prompt_ids"] = self.tokenizer(
                 self.class_prompt,
                 truncation=True,
@@ -139,12 +178,23 @@ class DreamBoothDataset(Dataset):
 
         return example
 
+def normalize_pixel_values(pixel_values):
+    """Convert uint8 images in [0, 255] to float tensors in [-1, 1]."""
+    return pixel_values.float().div_(127.5).sub_(1.0)
+
 def collate_fn(examples, with_prior_preservation=False):
     """Collate function for DreamBooth dataset."""
     has_attention_mask = "instance_attention_mask" in examples[0]
+    has_latents = "instance_latents" in examples[0]
+    has_jpeg = "instance_jpeg" in examples[0]
 
     input_ids = [example["instance_prompt_ids"] for example in examples]
-    pixel_values = [example["instance_images"] for example in examples]
+    if has_latents:
+        latents = [example["instance_latents"] for example in examples]
+    elif has_jpeg:
+        jpeg_bytes = [example["instance_jpeg"] for example in examples]
+    else:
+        pixel_values = [example["instance_images"] for example in examples]
 
     if has_attention_mask:
         attention_mask = [example["instance_attention_mask"] for example in examples]
@@ -153,19 +203,28 @@ def collate_fn(examples, with_prior_preservation=False):
     # We do this to avoid doing two forward passes.
     if with_prior_preservation:
         input_ids += [example["class_prompt_ids"] for example in examples]
-        pixel_values += [example["class_images"] for example in examples]
+        if has_latents:
+            latents += [example["class_latents"] for example in examples]
+        elif has_jpeg:
+            jpeg_bytes += [example["class_jpeg"] for example in examples]
+        else:
+            pixel_values += [example["class_images"] for example in examples]
         if has_attention_mask:
             attention_mask += [example["class_attention_mask"] for example in examples]
 
-    pixel_values = torch.stack(pixel_values)
-    pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
+    # CLIP token ids fit in int32, halving the bytes moved to the GPU
+    input_ids = torch.cat(input_ids, dim=0).to(torch.int32)
 
-    input_ids = torch.cat(input_ids, dim=0)
+    batch = {"input_ids": input_ids}
 
-    batch = {
-        "input_ids": input_ids,
-        "pixel_values": pixel_values,
-    }
+    if has_latents:
+        batch["latents"] = torch.stack(latents)
+    elif has_jpeg:
+        # Raw bytes stay as numpy arrays so they are not moved off the CPU before nvJPEG decoding
+        batch["jpeg_bytes"] = jpeg_bytes
+    else:
+        pixel_values = torch.stack(pixel_values)
+        batch["pixel_values"] = pixel_values.to(memory_format=torch.contiguous_format)
 
     if has_attention_mask:
         attention_mask = torch.cat(attention_mask, dim=0)
@@ -173,6 +232,48 @@ def collate_fn(examples, with_prior_preservation=False):
 
     return batch
 
+def apply_selective_checkpointing(unet):
+    """Checkpoint each transformer block, saving matmul/softmax outputs and recomputing elementwise ops."""
+    try:
+        from torch.utils.checkpoint import CheckpointPolicy, create_selective_checkpoint_contexts
+    except ImportError:
+        raise ImportError("Selective activation checkpointing requires PyTorch >= 2.4")
+
+    aten = torch.ops.aten
+    save_ops = {
+        aten.mm.default,
+        aten.bmm.default,
+        aten.addmm.default,
+        aten.baddbmm.default,
+        aten._softmax.default,
+        aten._scaled_dot_product_flash_attention.default,
+        aten._scaled_dot_product_efficient_attention.default,
+    }
+
+    def policy_fn(ctx, op, *args, **kwargs):
+        if op in save_ops:
+            return CheckpointPolicy.MUST_SAVE
+        return CheckpointPolicy.PREFER_RECOMPUTE
+
+    context_fn = functools.partial(create_selective_checkpoint_contexts, policy_fn)
+
+    def wrap_forward(block):
+        forward = block.forward
+
+        @functools.wraps(forward)
+        def checkpointed_forward(*args, **kwargs):
+            if not (block.training and torch.is_grad_enabled()):
+                return forward(*args, **kwargs)
+            return torch.utils.checkpoint.checkpoint(
+                forward, *args, use_reentrant=False, context_fn=context_fn, **kwargs
+            )
+
+        block.forward = checkpointed_forward
+
+    for module in unet.modules():
+        if isinstance(module, BasicTransformerBlock):
+            wrap_forward(module)
+
 class DreamBoothTrainer:
     """Main trainer class for DreamBooth fine-tuning."""
     
@@ -182,6 +283,17 @@ class DreamBoothTrainer:
         self.setup_accelerator()
         self.setup_logging()
         
+        # Steps of the checkpoints currently on disk, oldest first
+        self._ckpt_deque = self._scan_checkpoints()
+        
+        # Pruned checkpoints are renamed in here and deleted in the background. Leftovers of a run that
+        # exited before its deletions finished are purged first.
+        self._trash_dir = os.path.join(self.config.training.output_dir, ".trash")
+        self._discard_threads = []
+        if self.accelerator.is_main_process:
+            shutil.rmtree(self._trash_dir, ignore_errors=True)
+            os.makedirs(self._trash_dir, exist_ok=True)
+        
     def setup_accelerator(self):
         """Setup accelerator for distributed training."""
         logging_dir = Path(self.config.training.output_dir, self.config.logging.logging_dir)
@@ -191,13 +303,58 @@ class DreamBoothTrainer:
             logging_dir=logging_dir
         )
         
+        # bf16 keeps fp32 range, so no grad scaler is needed; use it whenever the GPU supports it
+        mixed_precision = self.config.memory.mixed_precision
+        bf16_supported = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+        if mixed_precision not in ("fp16", "no") and bf16_supported:
+            mixed_precision = "bf16"
+        elif mixed_precision == "bf16" and not bf16_supported:
+            logger.warning("bf16 is not supported on this device, falling back to fp16")
+            mixed_precision = "fp16"
+        self.config.memory.mixed_precision = mixed_precision
+        
+        # Let DDP alias gradients into its buckets and reuse the graph analysis across steps
+        ddp_kwargs = DistributedDataParallelKwargs(
+            gradient_as_bucket_view=True,
+            static_graph=True,
+            find_unused_parameters=False,
+        )
+        
         self.accelerator = Accelerator(
             gradient_accumulation_steps=self.config.training.gradient_accumulation_steps,
-            mixed_precision=self.config.memory.mixed_precision,
+            mixed_precision=mixed_precision,
             log_with=self.config.logging.report_to,
             project_config=accelerator_project_config,
+            kwargs_handlers=[ddp_kwargs],
+            # The prepared dataloader copies its pinned batches to the device asynchronously
+            dataloader_config=DataLoaderConfiguration(non_blocking=True),
         )
         
+    def _scan_checkpoints(self):
+        """List existing checkpoint steps in the output directory in a single scandir pass."""
+        output_dir = self.config.training.output_dir
+        if not os.path.isdir(output_dir):
+            return collections.deque()
+        with os.scandir(output_dir) as entries:
+            steps = sorted(
+                int(entry.name.split("-")[1]) for entry in entries if entry.name.startswith("checkpoint")
+            )
+        return collections.deque(steps)
+        
+    def _discard_checkpoint(self, checkpoint_path):
+        """Atomically move a checkpoint into the trash dir and delete it on a background thread."""
+        trash_path = os.path.join(self._trash_dir, f"{os.path.basename(checkpoint_path)}-{uuid.uuid4().hex}")
+        os.rename(checkpoint_path, trash_path)
+        thread = threading.Thread(target=shutil.rmtree, args=(trash_path,), kwargs={"ignore_errors": True}, daemon=True)
+        thread.start()
+        self._discard_threads.append(thread)
+        
+    def _wait_for_discards(self):
+        """Block until every background checkpoint deletion has finished."""
+        for thread in self._discard_threads:
+            thread.join()
+        self._discard_threads.clear()
+        
     def setup_logging(self):
         """Setup logging configuration."""
         if self.accelerator.is_local_main_process:
@@ -218,6 +375,12 @@ class DreamBoothTrainer:
             self.config.model.pretrained_model_name_or_path, 
             subfolder="scheduler"
         )
+        
+        # Noise schedule coefficients gathered per step by add-noise and the v-prediction target
+        alphas_cumprod = self.noise_scheduler.alphas_cumprod.to(self.accelerator.device, dtype=torch.float32)
+        self._sqrt_a = alphas_cumprod.sqrt()
+        self._sqrt_om = (1.0 - alphas_cumprod).sqrt()
+        
         self.tokenizer = CLIPTokenizer.from_pretrained(
             self.config.model.pretrained_model_name_or_path, 
             subfolder="tokenizer"
@@ -242,6 +405,14 @@ class DreamBoothTrainer:
         if not self.config.dataset.train_text_encoder:
             self.text_encoder.requires_grad_(False)
             
+        # Trainable weights must start in fp32; half-precision master weights break grad unscaling
+        if self.unet.dtype != torch.float32:
+            raise ValueError(f"UNet loaded as datatype {self.unet.dtype}. Trainable weights must be in float32.")
+        if self.config.dataset.train_text_encoder and self.text_encoder.dtype != torch.float32:
+            raise ValueError(
+                f"Text encoder loaded as datatype {self.text_encoder.dtype}. Trainable weights must be in float32."
+            )
+            
         # Enable memory efficient attention if available
         if is_xformers_available() and self.config.memory.enable_xformers_memory_efficient_attention:
             self.unet.enable_xformers_memory_efficient_attention()
@@ -250,15 +421,62 @@ class DreamBoothTrainer:
                 
         # Enable gradient checkpointing
         if self.config.memory.gradient_checkpointing:
-            self.unet.enable_gradient_checkpointing()
+            if self.config.memory.get("selective_checkpointing", False):
+                apply_selective_checkpointing(self.unet)
+            else:
+                self.unet.enable_gradient_checkpointing()
             if self.config.dataset.train_text_encoder:
                 self.text_encoder.gradient_checkpointing_enable()
                 
         logger.info("Models loaded successfully")
         
+    def precompute_prompt_embeddings(self):
+        """Encode the fixed instance and class prompts once when the text encoder is frozen."""
+        weight_dtype = torch.float32
+        if self.accelerator.mixed_precision == "fp16":
+            weight_dtype = torch.float16
+        elif self.accelerator.mixed_precision == "bf16":
+            weight_dtype = torch.bfloat16
+            
+        self.text_encoder.to(self.accelerator.device)
+        # inference_mode skips autograd bookkeeping entirely; clone so the cached
+        # embeddings are regular tensors that can feed the UNet's autograd graph
+        with torch.inference_mode():
+            instance_hidden_states = self._encode_prompt(self.config.dataset.instance_prompt).to(weight_dtype)
+            class_hidden_states = None
+            if self.config.dataset.with_prior_preservation:
+                class_hidden_states = self._encode_prompt(self.config.dataset.class_prompt).to(weight_dtype)
+        self.instance_hidden_states = instance_hidden_states.clone()
+        self.class_hidden_states = class_hidden_states.clone() if class_hidden_states is not None else None
+                
+        # The text encoder is only needed again to assemble the final pipeline
+        self.text_encoder.to("cpu")
+        logger.info("Cached prompt embeddings for the frozen text encoder")
+        
+    def _encode_prompt(self, prompt):
+        """Tokenize a prompt and return its text encoder hidden states."""
+        input_ids = self.tokenizer(
+            prompt,
+            truncation=True,
+            padding="max_length",
+            max_length=self.tokenizer.model_max_length,
+            return_tensors="pt",
+        ).input_ids
+        return self.text_encoder(input_ids.to(self.accelerator.device))[0]
+        
+    def _cached_hidden_states(self, bsz):
+        """Expand the cached prompt embeddings to match a (possibly prior-preserving) batch."""
+        if self.class_hidden_states is None:
+            return self.instance_hidden_states.expand(bsz, -1, -1)
+        half = bsz // 2
+        return torch.cat(
+            [self.instance_hidden_states.expand(half, -1, -1), self.class_hidden_states.expand(half, -1, -1)]
+        )
+        
     def setup_optimizer(self):
         """Setup optimizer and learning rate scheduler."""
         # Setup optimizer
+        optimizer_kwargs = {}
         if self.config.training.use_8bit_adam:
             try:
                 import bitsandbytes as bnb
@@ -267,6 +485,15 @@ class DreamBoothTrainer:
                 raise ImportError("To use 8-bit Adam, please install bitsandbytes")
         else:
             optimizer_cls = torch.optim.AdamW
+            # Full fine-tuning steps every UNet (and optionally text encoder) weight; the fused kernel does it in
+            # one launch, but only accepts CUDA parameters, so the trained models go to the GPU before prepare()
+            if torch.cuda.is_available():
+                self.unet.to(self.accelerator.device)
+                if self.config.dataset.train_text_encoder:
+                    self.text_encoder.to(self.accelerator.device)
+                optimizer_kwargs["fused"] = True
+            else:
+                optimizer_kwargs["foreach"] = True
             
         # Get trainable parameters
         params_to_optimize = list(self.unet.parameters())
@@ -279,6 +506,7 @@ class DreamBoothTrainer:
             betas=(self.config.training.adam_beta1, self.config.training.adam_beta2),
             weight_decay=self.config.training.adam_weight_decay,
             eps=self.config.training.adam_epsilon,
+            **optimizer_kwargs,
         )
         
         logger.info("Optimizer setup complete")
@@ -295,18 +523,92 @@ class DreamBoothTrainer:
             size=self.config.dataset.resolution,
             center_crop=self.config.dataset.center_crop,
             color_jitter=self.config.dataset.color_jitter,
+            gpu_decode=self.config.dataset.get("gpu_decode", False) and torch.cuda.is_available(),
         )
+        self.train_dataset = train_dataset
         
+        # The VAE is frozen, so encode every image once instead of on every step. A random crop or color
+        # jitter would be frozen into the cache, so caching needs deterministic preprocessing.
+        self.cache_latents = self.config.dataset.get("cache_latents", False)
+        if self.cache_latents and (not self.config.dataset.center_crop or self.config.dataset.color_jitter):
+            logger.warning("cache_latents requires center_crop and no color_jitter; encoding images every step instead")
+            self.cache_latents = False
+        if self.cache_latents:
+            self.precompute_latents(train_dataset)
+            
+        num_workers = self.config.training.dataloader_num_workers
         self.train_dataloader = torch.utils.data.DataLoader(
             train_dataset,
             batch_size=self.config.training.train_batch_size,
             shuffle=True,
             collate_fn=lambda examples: collate_fn(examples, self.config.dataset.with_prior_preservation),
-            num_workers=self.config.training.dataloader_num_workers,
+            num_workers=num_workers,
+            pin_memory=True,
+            persistent_workers=num_workers > 0,
+            prefetch_factor=4 if num_workers > 0 else None,
+            drop_last=True,
         )
         
         logger.info(f"Dataset setup complete. Training samples: {len(train_dataset)}")
         
+    def precompute_latents(self, train_dataset):
+        """Encode instance and class images with the VAE once and cache the latent distributions in memmapped files."""
+        logger.info("Precomputing VAE latents...")
+        cache_dir = Path(self.config.training.output_dir, "latent_cache")
+        if self.accelerator.is_main_process:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            
+        self.vae.to(self.accelerator.device, dtype=torch.float32)
+        train_dataset.instance_latents = self._encode_to_memmap(
+            train_dataset,
+            train_dataset.instance_images_path[:train_dataset.num_instance_images],
+            cache_dir / "instance_latents.npy",
+        )
+        if train_dataset.class_data_root is not None:
+            train_dataset.class_latents = self._encode_to_memmap(
+                train_dataset,
+                train_dataset.class_images_path[:train_dataset.num_class_images],
+                cache_dir / "class_latents.npy",
+            )
+            
+        # The VAE is only needed again to assemble the final pipeline
+        self.vae.to("cpu")
+        torch.cuda.empty_cache()
+        
+        logger.info(f"Cached latents to {cache_dir}")
+        
+    def _encode_to_memmap(self, train_dataset, image_paths, cache_path):
+        """Encode images into a float16 memmap of shape [N, 2C, H/8, W/8] and return it opened read-only.
+
+        Each row holds the latent distribution's mean and logvar concatenated on the channel
+        axis, so training draws a fresh latent every step as latent_dist.sample() would.
+        """
+        if self.accelerator.is_main_process:
+            vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+            latent_size = self.config.dataset.resolution // vae_scale_factor
+            latents_mmap = np.lib.format.open_memmap(
+                cache_path,
+                mode="w+",
+                dtype=np.float16,
+                shape=(len(image_paths), 2 * self.vae.config.latent_channels, latent_size, latent_size),
+            )
+            
+            batch_size = self.config.training.train_batch_size
+            with torch.no_grad():
+                for start in range(0, len(image_paths), batch_size):
+                    pixel_values = torch.stack(
+                        [train_dataset.load_image(path) for path in image_paths[start:start + batch_size]]
+                    )
+                    pixel_values = normalize_pixel_values(pixel_values.to(self.accelerator.device))
+                    parameters = self.vae.encode(pixel_values).latent_dist.parameters
+                    latents_mmap[start:start + len(parameters)] = parameters.cpu().numpy().astype(np.float16)
+                    
+            latents_mmap.flush()
+            del latents_mmap
+            
+        self.accelerator.wait_for_everyone()
+        return np.load(cache_path, mmap_mode="r")
+        
     def setup_lr_scheduler(self):
         """Setup learning rate scheduler."""
         self.lr_scheduler = get_scheduler(
@@ -322,8 +624,15 @@ class DreamBoothTrainer:
         """Main training loop."""
         logger.info("Starting DreamBooth training...")
         
+        # Seed before any data is loaded so the latent cache and augmentations are reproducible;
+        # offset per rank so augmentations differ across processes
+        if self.config.training.seed is not None:
+            set_seed(self.config.training.seed, device_specific=True)
+            
         # Setup everything
         self.load_models()
+        if not self.config.dataset.train_text_encoder:
+            self.precompute_prompt_embeddings()
         self.setup_optimizer()
         self.setup_dataset()
         self.setup_lr_scheduler()
@@ -338,20 +647,22 @@ class DreamBoothTrainer:
                 self.unet, self.optimizer, self.train_dataloader, self.lr_scheduler
             )
             
+        # Compile the trained models; batch size and resolution are fixed so shapes stay static
+        if self.config.training.get("torch_compile", False) and version.parse(torch.__version__) >= version.parse("2.1"):
+            self.unet = torch.compile(self.unet, mode="max-autotune", dynamic=False)
+            if self.config.dataset.train_text_encoder:
+                self.text_encoder = torch.compile(self.text_encoder, mode="max-autotune", dynamic=False)
+                
         # Move models to device
-        self.vae.to(self.accelerator.device, dtype=torch.float32)
-        if not self.config.dataset.train_text_encoder:
-            self.text_encoder.to(self.accelerator.device)
+        cache_latents = self.cache_latents
+        if not cache_latents:
+            self.vae.to(self.accelerator.device, dtype=torch.float32)
             
         # Calculate total training steps
         num_update_steps_per_epoch = math.ceil(len(self.train_dataloader) / self.config.training.gradient_accumulation_steps)
         if self.config.training.max_train_steps is None:
             self.config.training.max_train_steps = self.config.training.num_train_epochs * num_update_steps_per_epoch
             
-        # Set seed for reproducibility
-        if self.config.training.seed is not None:
-            set_seed(self.config.training.seed)
-            
         # Training loop
         total_batch_size = self.config.training.train_batch_size * self.accelerator.num_processes * self.config.training.gradient_accumulation_steps
         
@@ -366,16 +677,14 @@ class DreamBoothTrainer:
         
         global_step = 0
         first_epoch = 0
+        resume_step = 0
         
         # Resume from checkpoint if available
         if self.config.training.resume_from_checkpoint:
             if self.config.training.resume_from_checkpoint != "latest":
                 path = os.path.basename(self.config.training.resume_from_checkpoint)
             else:
-                dirs = os.listdir(self.config.training.output_dir)
-                dirs = [d for d in dirs if d.startswith("checkpoint")]
-                dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
-                path = dirs[-1] if len(dirs) > 0 else None
+                path = f"checkpoint-{self._ckpt_deque[-1]}" if len(self._ckpt_deque) > 0 else None
 
             if path is None:
                 logger.info("No checkpoint found, starting from scratch")
@@ -396,88 +705,128 @@ class DreamBoothTrainer:
             disable=not self.accelerator.is_local_main_process,
         )
         
+        # Bind config values used in the hot loop once; OmegaConf attribute lookups are not free
+        train_text_encoder = bool(self.config.dataset.train_text_encoder)
+        with_prior = bool(self.config.dataset.with_prior_preservation)
+        prior_loss_weight = float(self.config.dataset.get("prior_loss_weight", 1.0))
+        pred_type = self.config.advanced.get("prediction_type") or self.noise_scheduler.config.prediction_type
+        if pred_type not in ("epsilon", "v_prediction"):
+            raise ValueError(f"Unknown prediction type {pred_type}")
+        scaling_factor = self.vae.config.scaling_factor
+        num_train_timesteps = self.noise_scheduler.config.num_train_timesteps
+        max_grad_norm = self.config.training.max_grad_norm
+        set_grads_to_none = bool(self.config.memory.set_grads_to_none)
+        checkpointing_steps = int(self.config.training.checkpointing_steps)
+        checkpoints_total_limit = self.config.training.checkpoints_total_limit
+        output_dir = self.config.training.output_dir
+        log_every = int(self.config.logging.get("log_every", 1))
+        max_train_steps = int(self.config.training.max_train_steps)
+        params_to_clip = list(self.unet.parameters())
+        if train_text_encoder:
+            params_to_clip += list(self.text_encoder.parameters())
+            
+        # Allocated lazily from the first batch's latent shape
+        self._noise_buf = None
+        
+        # Running loss kept on device between logging steps
+        self._loss_accum = torch.zeros((), device=self.accelerator.device)
+        self._loss_count = 0
+        
         for epoch in range(first_epoch, self.config.training.num_train_epochs):
             self.unet.train()
-            if self.config.dataset.train_text_encoder:
+            if train_text_encoder:
                 self.text_encoder.train()
                 
-            for step, batch in enumerate(self.train_dataloader):
-                # Skip steps until we reach the resumed step
-                if self.config.training.resume_from_checkpoint and epoch == first_epoch and step < resume_step:
-                    if step % self.config.training.gradient_accumulation_steps == 0:
-                        progress_bar.update(1)
-                    continue
-                    
+            # Skip already-trained batches at the sampler level so they are never loaded.
+            # The progress bar starts at global_step, which already accounts for them.
+            if epoch == first_epoch and resume_step > 0:
+                epoch_dataloader = self.accelerator.skip_first_batches(self.train_dataloader, resume_step)
+            else:
+                epoch_dataloader = self.train_dataloader
+                
+            for step, batch in enumerate(epoch_dataloader):
                 with self.accelerator.accumulate(self.unet):
                     # Convert images to latent space
-                    latents = self.vae.encode(batch["pixel_values"].to(dtype=self.vae.dtype)).latent_dist.sample()
-                    latents = latents * self.vae.config.scaling_factor
+                    if cache_latents:
+                        # Sample a fresh latent from the cached distribution
+                        mean, logvar = batch["latents"].float().chunk(2, dim=1)
+                        std = torch.exp(0.5 * logvar.clamp(-30.0, 20.0))
+                        latents = mean + std * torch.randn_like(std)
+                    else:
+                        if "jpeg_bytes" in batch:
+                            pixel_values = self.train_dataset.decode_images(batch["jpeg_bytes"], self.accelerator.device)
+                        else:
+                            pixel_values = batch["pixel_values"]
+                        pixel_values = normalize_pixel_values(pixel_values)
+                        latents = self.vae.encode(pixel_values).latent_dist.sample()
+                    latents = latents * scaling_factor
                     
-                    # Sample noise
-                    noise = torch.randn_like(latents)
                     bsz = latents.shape[0]
                     
+                    # Noise and timesteps are written into persistent buffers to avoid per-step allocations
+                    if self._noise_buf is None:
+                        self._noise_buf = torch.empty_like(latents)
+                        self._ts_buf = torch.empty(bsz, dtype=torch.long, device=latents.device)
+                        self._gen = torch.Generator(device=latents.device)
+                        if self.config.training.seed is not None:
+                            self._gen.manual_seed(self.config.training.seed + self.accelerator.process_index)
+                        else:
+                            self._gen.seed()
+                            
+                    # Sample noise
+                    noise = self._noise_buf[:bsz]
+                    noise.normal_(generator=self._gen)
+                    
                     # Sample a random timestep for each image
-                    timesteps = torch.randint(0, self.noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device)
-                    timesteps = timesteps.long()
+                    timesteps = self._ts_buf[:bsz]
+                    torch.randint(0, num_train_timesteps, (bsz,), generator=self._gen, out=timesteps)
                     
                     # Add noise to the latents according to the noise magnitude at each timestep
-                    noisy_latents = self.noise_scheduler.add_noise(latents, noise, timesteps)
+                    sa = self._sqrt_a[timesteps].view(-1, 1, 1, 1)
+                    so = self._sqrt_om[timesteps].view(-1, 1, 1, 1)
+                    noisy_latents = torch.addcmul(sa * latents, so, noise)
                     
                     # Get the text embedding for conditioning
-                    encoder_hidden_states = self.text_encoder(batch["input_ids"])[0]
+                    if train_text_encoder:
+                        encoder_hidden_states = self.text_encoder(batch["input_ids"])[0]
+                    else:
+                        encoder_hidden_states = self._cached_hidden_states(bsz)
                     
                     # Get the target for loss depending on the prediction type
-                    if self.config.advanced.prediction_type is not None:
-                        if self.config.advanced.prediction_type == "epsilon":
-                            target = noise
-                        elif self.config.advanced.prediction_type == "v_prediction":
-                            target = self.noise_scheduler.get_velocity(latents, noise, timesteps)
-                        else:
-                            raise ValueError(f"Unknown prediction type {self.config.advanced.prediction_type}")
+                    if pred_type == "epsilon":
+                        target = noise
                     else:
-                        if self.noise_scheduler.config.prediction_type == "epsilon":
-                            target = noise
-                        elif self.noise_scheduler.config.prediction_type == "v_prediction":
-                            target = self.noise_scheduler.get_velocity(latents, noise, timesteps)
-                        else:
-                            raise ValueError(f"Unknown prediction type {self.noise_scheduler.config.prediction_type}")
+                        # v = sqrt(a) * noise - sqrt(1 - a) * latents
+                        target = torch.addcmul(sa * noise, so, latents, value=-1.0)
                             
                     # Predict the noise residual and compute loss
                     model_pred = self.unet(noisy_latents, timesteps, encoder_hidden_states).sample
                     
-                    if self.config.dataset.with_prior_preservation:
-                        # Chunk the noise and model_pred into two parts and compute the loss on each part separately.
-                        model_pred, model_pred_prior = torch.chunk(model_pred, 2, dim=0)
-                        target, target_prior = torch.chunk(target, 2, dim=0)
-                        
-                        # Compute instance loss
-                        loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
-                        
-                        # Compute prior loss
-                        prior_loss = F.mse_loss(model_pred_prior.float(), target_prior.float(), reduction="mean")
-                        
-                        # Add the prior loss to the instance loss.
-                        loss = loss + prior_loss
+                    if with_prior:
+                        # Instance and class halves are the same size, so with equal weights the sum of the
+                        # two per-half means is twice the mean over the concatenated batch.
+                        if prior_loss_weight == 1.0:
+                            loss = 2 * F.mse_loss(model_pred.float(), target.float(), reduction="mean")
+                        else:
+                            # Compute the squared error once and reduce each half separately
+                            err = F.mse_loss(model_pred.float(), target.float(), reduction="none")
+                            err = err.view(2, -1).mean(dim=1)
+                            loss = err[0] + prior_loss_weight * err[1]
                     else:
                         loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
                         
-                    # Gather the losses across all processes for logging (if we use distributed training).
-                    avg_loss = self.accelerator.gather(loss.repeat(self.config.training.train_batch_size)).mean()
+                    # Accumulate the loss on device; it is only read back on logging steps
+                    self._loss_accum += loss.detach()
+                    self._loss_count += 1
                     
                     # Backpropagate
                     self.accelerator.backward(loss)
                     if self.accelerator.sync_gradients:
-                        params_to_clip = (
-                            list(self.unet.parameters()) + list(self.text_encoder.parameters())
-                            if self.config.dataset.train_text_encoder
-                            else list(self.unet.parameters())
-                        )
-                        self.accelerator.clip_grad_norm_(params_to_clip, self.config.training.max_grad_norm)
+                        self.accelerator.clip_grad_norm_(params_to_clip, max_grad_norm)
                         
                     self.optimizer.step()
                     self.lr_scheduler.step()
-                    self.optimizer.zero_grad(set_to_none=self.config.memory.set_grads_to_none)
+                    self.optimizer.zero_grad(set_to_none=set_grads_to_none)
                     
                 # Checks if the accelerator has performed an optimization step behind the scenes
                 if self.accelerator.sync_gradients:
@@ -485,33 +834,34 @@ class DreamBoothTrainer:
                     global_step += 1
                     
                     # Save checkpoint
-                    if global_step % self.config.training.checkpointing_steps == 0:
+                    if global_step % checkpointing_steps == 0:
                         if self.accelerator.is_main_process:
                             # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
-                            if self.config.training.checkpoints_total_limit is not None:
-                                checkpoints = os.listdir(self.config.training.output_dir)
-                                checkpoints = [d for d in checkpoints if d.startswith("checkpoint")]
-                                checkpoints = sorted(checkpoints, key=lambda x: int(x.split("-")[1]))
-                                
+                            if checkpoints_total_limit is not None:
                                 # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
-                                if len(checkpoints) >= self.config.training.checkpoints_total_limit:
-                                    num_to_remove = len(checkpoints) - self.config.training.checkpoints_total_limit + 1
-                                    removing_checkpoints = checkpoints[0:num_to_remove]
-                                    
-                                    logger.info(f"Removing {len(removing_checkpoints)} checkpoints to stay under limit")
-                                    for removing_checkpoint in removing_checkpoints:
-                                        removing_checkpoint = os.path.join(self.config.training.output_dir, removing_checkpoint)
-                                        shutil.rmtree(removing_checkpoint)
+                                num_to_remove = len(self._ckpt_deque) - checkpoints_total_limit + 1
+                                if num_to_remove > 0:
+                                    logger.info(f"Removing {num_to_remove} checkpoints to stay under limit")
+                                    for _ in range(num_to_remove):
+                                        removing_checkpoint = f"checkpoint-{self._ckpt_deque.popleft()}"
+                                        self._discard_checkpoint(os.path.join(output_dir, removing_checkpoint))
                                         
-                            save_path = os.path.join(self.config.training.output_dir, f"checkpoint-{global_step}")
+                            save_path = os.path.join(output_dir, f"checkpoint-{global_step}")
                             self.accelerator.save_state(save_path)
+                            self._ckpt_deque.append(global_step)
                             logger.info(f"Saved state to {save_path}")
                             
-                logs = {"loss": avg_loss.detach().item(), "lr": self.lr_scheduler.get_last_lr()[0]}
-                progress_bar.set_postfix(**logs)
-                self.accelerator.log(logs, step=global_step)
-                
-                if global_step >= self.config.training.max_train_steps:
+                    # Gather the losses across all processes for logging (if we use distributed training).
+                    # This is the only host-device sync, so it runs on the logging cadence rather than every step.
+                    if global_step % log_every == 0:
+                        avg_loss = self.accelerator.gather(self._loss_accum / self._loss_count).mean()
+                        logs = {"loss": avg_loss.item(), "lr": self.lr_scheduler.get_last_lr()[0]}
+                        progress_bar.set_postfix(**logs)
+                        self.accelerator.log(logs, step=global_step)
+                        self._loss_accum.zero_()
+                        self._loss_count = 0
+                        
+                if global_step >= max_train_steps:
                     break
                     
         # Create the pipeline using the trained modules and save it.
@@ -524,10 +874,14 @@ class DreamBoothTrainer:
     def save_pipeline(self):
         """Save the trained pipeline."""
         logger.info("Saving pipeline...")
+        # Finish pruning old checkpoints so no half-deleted tree is left in output_dir
+        self._wait_for_discards()
         
         unet = self.accelerator.unwrap_model(self.unet)
+        unet = unet._orig_mod if is_compiled_module(unet) else unet
         if self.config.dataset.train_text_encoder:
             text_encoder = self.accelerator.unwrap_model(self.text_encoder)
+            text_encoder = text_encoder._orig_mod if is_compiled_module(text_encoder) else text_encoder
         else:
             text_encoder = self.text_encoder
             
@@ -548,7 +902,7 @@ class DreamBoothTrainer:
                 repo_id=self.config.hub.hub_model_id,
                 folder_path=self.config.training.output_dir,
                 commit_message="End of training",
-                ignore_patterns=["step_*", "epoch_*"],
+                ignore_patterns=["step_*", "epoch_*", ".trash/*"],
             )
             
         logger.info(f"Pipeline saved to {self.config.training.output_dir}")
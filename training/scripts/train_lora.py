@@ -11,21 +11,27 @@ Usage:
 """
 
 import argparse
+import contextlib
+import functools
+import hashlib
+import json
 import logging
 import math
 import os
 import random
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
 import numpy as np
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.checkpoint
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import ProjectConfiguration, set_seed
+from accelerate.utils import GradientAccumulationPlugin, ProjectConfiguration, send_to_device, set_seed
 from datasets import load_dataset
 from diffusers import (
     AutoencoderKL,
@@ -39,12 +45,15 @@ from diffusers.optimization import get_scheduler
 from diffusers.training_utils import EMAModel
 from diffusers.utils import check_min_version, is_wandb_available
 from diffusers.utils.import_utils import is_xformers_available
+from diffusers.utils.torch_utils import is_compiled_module
 from huggingface_hub import create_repo, upload_folder
 from omegaconf import OmegaConf
-from diffusers.models.attention_processor import LoRAAttnProcessor
-from PIL import Image
-from torch.utils.data import Dataset
+from packaging import version
+from safetensors.torch import save_file
+from diffusers.models.attention_processor import LoRAAttnProcessor, LoRAAttnProcessor2_0
+from torch.utils.data import Dataset, Sampler
 from torchvision import transforms
+from torchvision.io import ImageReadMode, read_image
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
 
@@ -60,23 +69,20 @@ logger = get_logger(__name__)
 check_min_version("0.21.0")
 
 class LoRADataset(Dataset):
-    """Dataset for LoRA training with text-image pairs."""
+    """Dataset for LoRA training with text-image pairs.
+
+    Images are returned as raw uint8 tensors; resizing, augmentation and normalization
+    run batched on the GPU (see `LoRATrainer.gpu_transform`), so all images in a
+    dataset must share the same dimensions, as produced by `dataset_preparation.py`.
+    """
     
     def __init__(
         self,
         data_root,
         tokenizer,
-        size=512,
-        center_crop=False,
-        random_flip=False,
-        color_jitter=False,
     ):
         self.data_root = Path(data_root)
         self.tokenizer = tokenizer
-        self.size = size
-        self.center_crop = center_crop
-        self.random_flip = random_flip
-        self.color_jitter = color_jitter
         
         self.images_dir = self.data_root / 'images'
         self.captions_dir = self.data_root / 'captions'
@@ -87,57 +93,291 @@ class LoRADataset(Dataset):
         self.image_files = list(self.images_dir.glob('*.jpg')) + list(self.images_dir.glob('*.jpeg'))
         self.image_files = sorted(self.image_files)
         
-        self.captions = []
-        for image_file in self.image_files:
-            caption_file = self.captions_dir / f"{image_file.stem}.txt"
-            if caption_file.exists():
-                with open(caption_file, 'r', encoding='utf-8') as f:
-                    caption = f.read().strip()
-                self.captions.append(caption)
-            else:
-                self.captions.append(f"A photo of {image_file.stem}")
+        # Encoded file size is a cheap proxy for per-sample decode cost
+        self.sizes = np.array([f.stat().st_size for f in self.image_files])
+        
+        # Caption reads are small and latency-bound, so overlap them across threads
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            self.captions = list(executor.map(self.read_caption, self.image_files))
                 
-        self.image_transforms = transforms.Compose([
-            transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR),
-            transforms.CenterCrop(size) if center_crop else transforms.RandomCrop(size),
-            transforms.RandomHorizontalFlip() if random_flip else transforms.Lambda(lambda x: x),
-            transforms.ColorJitter(0.1, 0.1) if color_jitter else transforms.Lambda(lambda x: x),
-            transforms.ToTensor(),
-            transforms.Normalize([0.5], [0.5]),
-        ])
+        # Tokenize every caption once so __getitem__ is a plain tensor slice
+        self.input_ids = self.tokenizer(
+            self.captions,
+            truncation=True,
+            padding="max_length",
+            max_length=self.tokenizer.model_max_length,
+            return_tensors="pt",
+        ).input_ids
+        
+        # Memory-mapped VAE latent statistics, attached by the trainer when latent caching is enabled:
+        # the scaled mean in float16 and the log-variance as per-sample int8 with its (min, max) range
+        self.latents_mean = None
+        self.latents_logvar = None
+        self.logvar_range = None
+        
+        # Memory-mapped text encoder hidden states, one row per unique caption, and each sample's row in it;
+        # attached when text embedding caching is enabled
+        self.text_emb = None
+        self.text_emb_index = None
         
     def __len__(self):
         return len(self.image_files)
         
-    def __getitem__(self, index):
-        image = Image.open(self.image_files[index]).convert("RGB")
-        image = self.image_transforms(image)
+    def read_caption(self, image_file):
+        caption_file = self.captions_dir / f"{image_file.stem}.txt"
+        if caption_file.exists():
+            return caption_file.read_text(encoding='utf-8').strip()
+        return f"A photo of {image_file.stem}"
         
-        caption = self.captions[index]
-        input_ids = self.tokenizer(
-            caption,
-            truncation=True,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            return_tensors="pt",
-        ).input_ids[0]
+    def load_image(self, index):
+        """Decode an image from disk into a uint8 CHW tensor."""
+        return read_image(str(self.image_files[index]), ImageReadMode.RGB)
         
-        return {
-            "pixel_values": image,
-            "input_ids": input_ids,
-        }
+    def __getitem__(self, index):
+        example = {}
+        if self.latents_mean is not None:
+            example["latents_mean"] = torch.from_numpy(np.array(self.latents_mean[index]))
+            example["latents_logvar"] = torch.from_numpy(np.array(self.latents_logvar[index]))
+            example["logvar_range"] = torch.from_numpy(np.array(self.logvar_range[index]))
+        else:
+            example["pixel_values"] = self.load_image(index)
+            
+        if self.text_emb is not None:
+            example["text_emb"] = torch.from_numpy(np.array(self.text_emb[self.text_emb_index[index]]))
+        else:
+            example["input_ids"] = self.input_ids[index]
+            
+        return example
 
 def collate_fn(examples):
     """Collate function for LoRA dataset."""
-    pixel_values = torch.stack([example["pixel_values"] for example in examples])
-    pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
+    # Every field is a fixed-shape tensor (pixel_values stay uint8; float conversion happens on the GPU)
+    return {key: torch.stack([example[key] for example in examples]) for key in examples[0]}
+
+def quantize_logvar(logvar):
+    """Quantize a (B, C, H, W) log-variance batch to int8 with a per-sample affine (min, max) range."""
+    flat = logvar.flatten(1)
+    lo = flat.min(dim=1).values
+    hi = torch.maximum(flat.max(dim=1).values, lo + 1e-6)
+    scale = ((hi - lo) / 254).view(-1, 1, 1, 1)
+    q = ((logvar - lo.view(-1, 1, 1, 1)) / scale).round_().sub_(127).to(torch.int8)
+    return q, torch.stack([lo, hi], dim=1)
+
+def dequantize_logvar(q, logvar_range):
+    """Inverse of `quantize_logvar`."""
+    lo, hi = logvar_range.float().unbind(1)
+    scale = ((hi - lo) / 254).view(-1, 1, 1, 1)
+    return (q.float() + 127) * scale + lo.view(-1, 1, 1, 1)
+
+def sha256_file(path, chunk_size=1 << 20):
+    """Return the hex sha256 digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class PinnedBatchCollator:
+    """Collate function that copies samples straight into preallocated pinned batch buffers.
+
+    Avoids the stack-then-pin double copy of the default path. A small ring of buffers is
+    rotated, and a buffer is only refilled once the event recorded after its last
+    non_blocking host-to-device copy (see `record_copy`) has completed. Inside worker
+    processes the default collate already stacks into shared memory, so it is used as is.
+    """
+    
+    def __init__(self, batch_size, num_buffers=4):
+        self.batch_size = batch_size
+        self.num_buffers = num_buffers
+        self.buffers = None
+        self.copy_events = [None] * num_buffers
+        self.index = 0
+        
+    def record_copy(self, batch, event):
+        """Mark the buffer backing `batch` as in flight until `event` completes."""
+        if self.buffers is None:
+            return
+        # Match by storage: the dataloader may already have collated further batches ahead of this one
+        key = next(iter(batch))
+        for i, buffers in enumerate(self.buffers):
+            if buffers[key].data_ptr() == batch[key].data_ptr():
+                self.copy_events[i] = event
+                return
+        
+    def __call__(self, examples):
+        if torch.utils.data.get_worker_info() is not None or not torch.cuda.is_available():
+            return collate_fn(examples)
+            
+        if self.buffers is None:
+            self.buffers = [
+                {
+                    key: torch.empty((self.batch_size, *value.shape), dtype=value.dtype, pin_memory=True)
+                    for key, value in examples[0].items()
+                }
+                for _ in range(self.num_buffers)
+            ]
+            
+        # The CPU can run many steps ahead of the GPU; never overwrite a buffer whose copy is still pending
+        if self.copy_events[self.index] is not None:
+            self.copy_events[self.index].synchronize()
+            self.copy_events[self.index] = None
+        buffers = self.buffers[self.index]
+        self.index = (self.index + 1) % self.num_buffers
+        
+        batch = {}
+        for key, buf in buffers.items():
+            for i, example in enumerate(examples):
+                buf[i].copy_(example[key])
+            batch[key] = buf[:len(examples)]
+        return batch
+
+class PerSampleAugment(nn.Module):
+    """Random crop, horizontal flip and brightness/contrast jitter with independent draws per image.
+
+    torchvision's v1 RandomCrop / RandomHorizontalFlip / ColorJitter draw one set of parameters
+    per call, which would give every image of a (B, C, H, W) batch the same augmentation.
+    Expects float images in [0, 1].
+    """
     
-    input_ids = torch.stack([example["input_ids"] for example in examples])
+    def __init__(self, size, random_crop=False, random_flip=False, color_jitter=False, jitter=0.1):
+        super().__init__()
+        self.size = size
+        self.random_crop = random_crop
+        self.random_flip = random_flip
+        self.color_jitter = color_jitter
+        self.jitter = jitter
+        
+    def forward(self, images):
+        batch_size, _, height, width = images.shape
+        device = images.device
+        
+        if self.random_crop:
+            # Offsets are drawn on the CPU so slicing needs no device sync
+            tops = torch.randint(0, height - self.size + 1, (batch_size,)).tolist()
+            lefts = torch.randint(0, width - self.size + 1, (batch_size,)).tolist()
+            images = torch.stack([
+                image[:, top:top + self.size, left:left + self.size]
+                for image, top, left in zip(images, tops, lefts)
+            ])
+            
+        if self.random_flip:
+            flip = torch.rand(batch_size, 1, 1, 1, device=device) < 0.5
+            images = torch.where(flip, images.flip(-1), images)
+            
+        if self.color_jitter:
+            brightness = torch.empty(batch_size, 1, 1, 1, device=device).uniform_(1 - self.jitter, 1 + self.jitter)
+            images = (images * brightness).clamp_(0, 1)
+            # Contrast blends each image with the mean of its own grayscale version
+            contrast = torch.empty(batch_size, 1, 1, 1, device=device).uniform_(1 - self.jitter, 1 + self.jitter)
+            gray = (0.299 * images[:, 0] + 0.587 * images[:, 1] + 0.114 * images[:, 2]).mean(dim=(1, 2))
+            gray = gray.view(batch_size, 1, 1, 1)
+            images = ((images - gray) * contrast + gray).clamp_(0, 1)
+        return images
+
+def cast_trainable_params_to_fp32(model):
+    """Upcast only the trainable (LoRA) parameters to fp32 so the optimizer keeps fp32 master weights."""
+    for param in model.parameters():
+        if param.requires_grad:
+            param.data = param.data.float()
+
+class CostBucketBatchSampler(Sampler):
+    """Batch sampler that groups samples of similar cost so no batch waits on one slow outlier.
+
+    Indices are sorted by cost and split into `num_buckets` buckets. Each epoch the indices
+    are shuffled within their bucket, chunked into batches, and the batch order is shuffled.
+    A bucket's leftover samples are carried into the next bucket, so only the final batch of
+    an epoch can be partial.
+    """
     
-    return {
-        "pixel_values": pixel_values,
-        "input_ids": input_ids,
-    }
+    def __init__(self, sizes, batch_size, num_buckets=32, drop_last=False, seed=0):
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        
+        order = np.argsort(sizes, kind="stable")
+        self.buckets = [bucket for bucket in np.array_split(order, min(num_buckets, len(order))) if len(bucket)]
+        
+    def __len__(self):
+        num_samples = sum(len(bucket) for bucket in self.buckets)
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return math.ceil(num_samples / self.batch_size)
+        
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        
+        batches = []
+        leftover = np.empty(0, dtype=np.int64)
+        for bucket in self.buckets:
+            bucket = np.concatenate([leftover, rng.permutation(bucket)])
+            num_full = len(bucket) // self.batch_size * self.batch_size
+            for start in range(0, num_full, self.batch_size):
+                batches.append(bucket[start:start + self.batch_size].tolist())
+            leftover = bucket[num_full:]
+        if len(leftover) and not self.drop_last:
+            batches.append(leftover.tolist())
+                    
+        for i in rng.permutation(len(batches)):
+            yield batches[i]
+
+class CudaPrefetcher:
+    """Iterate a dataloader while copying the next batch to the device on a side CUDA stream.
+
+    The copy of batch N+1 overlaps the forward/backward of batch N; the compute stream waits
+    on the copy stream only when the batch is handed out. Without CUDA the copy is synchronous.
+    The read-ahead makes accelerate's end-of-dataloader flag unreliable, so gradient sync must
+    not depend on it (see `LoRATrainer.setup_accelerator`).
+    """
+    
+    def __init__(self, loader, device):
+        # A PinnedBatchCollator must learn when each of its pinned buffers has been copied out
+        self.collator = getattr(loader, "collate_fn", None)
+        self.loader = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self._preload()
+        
+    def _preload(self):
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.next_batch = None
+            return
+            
+        with torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext():
+            self.next_batch = {key: value.to(self.device, non_blocking=True) for key, value in batch.items()}
+            if self.stream is not None and hasattr(self.collator, "record_copy"):
+                copy_done = torch.cuda.Event()
+                copy_done.record(self.stream)
+                self.collator.record_copy(batch, copy_done)
+            
+    def __iter__(self):
+        return self
+        
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+            
+        batch = self.next_batch
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            # Tell the caching allocator the tensors are now used on the compute stream
+            for value in batch.values():
+                value.record_stream(current_stream)
+        self._preload()
+        return batch
+
+def _write_checkpoint(save_path, lora_state, training_state, copy_done=None):
+    """Write a checkpoint snapshot to disk; runs on the trainer's save thread."""
+    if copy_done is not None:
+        copy_done.synchronize()
+    os.makedirs(save_path, exist_ok=True)
+    save_file(lora_state, os.path.join(save_path, "pytorch_lora_weights.safetensors"))
+    torch.save(training_state, os.path.join(save_path, "training_state.pt"), _use_new_zipfile_serialization=True)
+    logger.info(f"Saved state to {save_path}")
 
 class LoRATrainer:
     """Main trainer class for LoRA fine-tuning."""
@@ -147,6 +387,11 @@ class LoRATrainer:
         self.config = OmegaConf.load(config_path)
         self.setup_accelerator()
         self.setup_logging()
+        self.gpu_transform = self.build_gpu_transform()
+        
+        # Checkpoint files are written on a background thread; at most one save is in flight
+        self._save_pool = ThreadPoolExecutor(max_workers=1)
+        self._save_future = None
         
     def setup_accelerator(self):
         """Setup accelerator for distributed training."""
@@ -157,13 +402,50 @@ class LoRATrainer:
             logging_dir=logging_dir
         )
         
+        # bf16 keeps fp32 range, so the frozen VAE stays stable without a loss scaler
+        mixed_precision = self.config.memory.mixed_precision
+        bf16_supported = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+        if mixed_precision != "no" and bf16_supported:
+            mixed_precision = "bf16"
+        elif mixed_precision == "bf16" and not bf16_supported:
+            logger.warning("bf16 is not supported on this device, falling back to fp16")
+            mixed_precision = "fp16"
+        self.config.memory.mixed_precision = mixed_precision
+        
+        # CudaPrefetcher reads one batch ahead of the prepared dataloader, so accelerate's end-of-dataloader
+        # flag fires a micro-batch early. Sync on the micro-step count alone: every accumulation window is
+        # exactly gradient_accumulation_steps batches, carrying over epoch boundaries.
+        gradient_accumulation_plugin = GradientAccumulationPlugin(
+            num_steps=self.config.training.gradient_accumulation_steps,
+            sync_with_dataloader=False,
+        )
+        
         self.accelerator = Accelerator(
-            gradient_accumulation_steps=self.config.training.gradient_accumulation_steps,
-            mixed_precision=self.config.memory.mixed_precision,
+            gradient_accumulation_plugin=gradient_accumulation_plugin,
+            mixed_precision=mixed_precision,
             log_with=self.config.logging.report_to,
             project_config=accelerator_project_config,
         )
         
+    def build_gpu_transform(self):
+        """Build the batched image transform that runs on uint8 batches on the GPU."""
+        size = self.config.dataset.resolution
+        random_crop = not self.config.dataset.center_crop
+        tfms = [transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR, antialias=True)]
+        if not random_crop:
+            tfms.append(transforms.CenterCrop(size))
+        tfms.append(transforms.ConvertImageDtype(torch.float32))
+        # Disabled augmentations are left out entirely rather than kept as identity modules
+        if random_crop or self.config.dataset.random_flip or self.config.dataset.color_jitter:
+            tfms.append(PerSampleAugment(
+                size,
+                random_crop=random_crop,
+                random_flip=self.config.dataset.random_flip,
+                color_jitter=self.config.dataset.color_jitter,
+            ))
+        tfms.append(transforms.Normalize([0.5] * 3, [0.5] * 3))
+        return nn.Sequential(*tfms)
+        
     def setup_logging(self):
         """Setup logging configuration."""
         if self.accelerator.is_local_main_process:
@@ -183,6 +465,18 @@ class LoRATrainer:
             self.config.model.pretrained_model_name_or_path, 
             subfolder="scheduler"
         )
+        if self.noise_scheduler.config.prediction_type not in ("epsilon", "v_prediction"):
+            raise ValueError(f"Unknown prediction type {self.noise_scheduler.config.prediction_type}")
+        
+        # Noise schedule coefficients gathered per step by add-noise and the v-prediction target
+        alphas_cumprod = self.noise_scheduler.alphas_cumprod.to(self.accelerator.device, dtype=torch.float32)
+        self.sqrt_ac = alphas_cumprod.sqrt()
+        self.sqrt_1mac = (1.0 - alphas_cumprod).sqrt()
+        
+        # Per-timestep SNR for Min-SNR loss weighting
+        self.snr = alphas_cumprod / (1.0 - alphas_cumprod)
+        self.snr_gamma = self.config.advanced.get("snr_gamma") or self.config.advanced.get("min_snr_gamma")
+        
         self.tokenizer = CLIPTokenizer.from_pretrained(
             self.config.model.pretrained_model_name_or_path, 
             subfolder="tokenizer"
@@ -203,6 +497,49 @@ class LoRATrainer:
         
         self.vae.requires_grad_(False)
         self.text_encoder.requires_grad_(False)
+        self.unet.requires_grad_(False)
+        
+        # Frozen weights run in the mixed precision dtype; only the LoRA weights are trained
+        self.weight_dtype = torch.float32
+        if self.accelerator.mixed_precision == "fp16":
+            self.weight_dtype = torch.float16
+        elif self.accelerator.mixed_precision == "bf16":
+            self.weight_dtype = torch.bfloat16
+        # The SD VAE overflows to NaN in fp16, so on the fp16 fallback it stays in fp32
+        self.vae_dtype = torch.bfloat16 if self.weight_dtype == torch.bfloat16 else torch.float32
+        self.vae.to(dtype=self.vae_dtype)
+        self.text_encoder.to(dtype=self.weight_dtype)
+        self.unet.to(dtype=self.weight_dtype)
+        
+        # No gradient flows through the frozen text encoder, so int8 weights only trade a little encode accuracy
+        # for VRAM. The VAE is left alone: int8_weight_only only replaces nn.Linear and the VAE is almost all Conv2d.
+        if self.config.memory.get("quantize_text_encoder", False):
+            try:
+                from torchao.quantization import int8_weight_only, quantize_
+            except ImportError:
+                raise ImportError("To quantize the frozen text encoder, please install torchao")
+            quantize_(self.text_encoder, int8_weight_only())
+            
+        # The frozen convolutions dominate LoRA step time; in channels_last cuDNN can use its tensor-core kernels
+        self.unet.to(memory_format=torch.channels_last)
+        self.vae.to(memory_format=torch.channels_last)
+        
+        # PyTorch SDPA dispatches to FlashAttention-2 on Ampere and newer; xformers is only a fallback for older GPUs
+        has_sdpa = hasattr(F, "scaled_dot_product_attention")
+        sm80 = torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+        use_xformers = (
+            self.config.memory.enable_xformers_memory_efficient_attention
+            and is_xformers_available()
+            and not (has_sdpa and sm80)
+        )
+        lora_attn_processor_cls = LoRAAttnProcessor2_0 if has_sdpa else LoRAAttnProcessor
+        
+        # Restrict SDPA to the flash / memory-efficient kernels so a silent fallback to the math path fails loudly
+        self.sdp_context = contextlib.nullcontext
+        if has_sdpa and sm80 and not use_xformers:
+            self.sdp_context = functools.partial(
+                torch.backends.cuda.sdp_kernel, enable_flash=True, enable_mem_efficient=True, enable_math=False
+            )
         
         rank = self.config.lora.rank
         lora_attn_procs = {}
@@ -222,39 +559,90 @@ class LoRATrainer:
             else:
                 # Fallback
                 hidden_size = self.unet.config.block_out_channels[0]
-            lora_attn_procs[name] = LoRAAttnProcessor(hidden_size=hidden_size, cross_attention_dim=cross_attention_dim, rank=rank)
+            lora_attn_procs[name] = lora_attn_processor_cls(hidden_size=hidden_size, cross_attention_dim=cross_attention_dim, rank=rank)
         self.unet.set_attn_processor(lora_attn_procs)
+        
+        # LoRA parameters and optimizer state stay in fp32 while the base UNet runs in low precision
+        cast_trainable_params_to_fp32(self.unet)
 
-        # Enable memory efficient attention if available
-        if is_xformers_available() and self.config.memory.enable_xformers_memory_efficient_attention:
+        if use_xformers:
             self.unet.enable_xformers_memory_efficient_attention()
             
         # Enable gradient checkpointing
         if self.config.memory.gradient_checkpointing:
             self.unet.enable_gradient_checkpointing()
             
+        # Compile the UNet, the noising step and the loss; resolution and batch size are fixed so shapes stay static.
+        # The VAE and text encoder stay eager to avoid graph breaks around latent_dist.sample().
+        self.fused_noise = self._fused_noise
+        self.compute_loss = self._compute_loss
+        if self.config.training.get("torch_compile", True) and version.parse(torch.__version__) >= version.parse("2.1"):
+            self.unet = torch.compile(self.unet, mode="max-autotune", fullgraph=False, dynamic=False)
+            self.fused_noise = torch.compile(self._fused_noise, dynamic=False)
+            self.compute_loss = torch.compile(self._compute_loss, dynamic=False)
+            
         logger.info("Models loaded successfully")
         logger.info(f"LoRA trainable parameters: {self.unet.get_nb_trainable_parameters()}")
         
+    def _fused_noise(self, latents, timesteps):
+        """Sample noise and return the noisy latents and the prediction target in one pass."""
+        a = self.sqrt_ac[timesteps].view(-1, 1, 1, 1)
+        b = self.sqrt_1mac[timesteps].view(-1, 1, 1, 1)
+        noise = torch.randn_like(latents)
+        noisy_latents = torch.addcmul(a * latents, b, noise)
+        
+        if self.noise_scheduler.config.prediction_type == "epsilon":
+            target = noise
+        else:
+            # v = sqrt(a) * noise - sqrt(1 - a) * latents
+            target = torch.addcmul(a * noise, b, latents, value=-1.0)
+        return noisy_latents, target
+        
+    def _compute_loss(self, model_pred, target, timesteps):
+        """Return the MSE loss between the prediction and the target, Min-SNR weighted when `snr_gamma` is set."""
+        if self.snr_gamma is None:
+            return F.mse_loss(model_pred, target, reduction="mean")
+            
+        # Min-SNR-gamma: weight = min(snr, gamma) / snr for epsilon, / (snr + 1) for v-prediction
+        snr = self.snr[timesteps]
+        if self.noise_scheduler.config.prediction_type == "v_prediction":
+            weights = snr.clamp(max=self.snr_gamma) / (snr + 1)
+        else:
+            weights = snr.clamp(max=self.snr_gamma) / snr
+        loss = F.mse_loss(model_pred, target, reduction="none").mean(dim=[1, 2, 3])
+        return (loss * weights).mean()
+        
     def setup_optimizer(self):
         """Setup optimizer and learning rate scheduler."""
+        optimizer_kwargs = {}
         if self.config.training.use_8bit_adam:
             try:
                 import bitsandbytes as bnb
-                optimizer_cls = bnb.optim.AdamW8bit
+                # Paged optimizer state spills to CPU-mapped pages instead of OOMing on spikes
+                optimizer_cls = bnb.optim.PagedAdamW8bit
             except ImportError:
                 raise ImportError("To use 8-bit Adam, please install bitsandbytes")
         else:
             optimizer_cls = torch.optim.AdamW
+            # Hundreds of tiny LoRA tensors make per-tensor AdamW launch-bound; the fused kernel steps them all at
+            # once. The LoRA weights live inside the UNet, which must already be on CUDA for fused=True.
+            if torch.cuda.is_available():
+                self.unet.to(self.accelerator.device)
+                optimizer_kwargs["fused"] = True
+            else:
+                optimizer_kwargs["foreach"] = True
             
-        params_to_optimize = list(filter(lambda p: p.requires_grad, self.unet.parameters()))
+        # Materialized once and reused as the gradient clipping target every optimizer step
+        self.params_to_optimize = [p for p in self.unet.parameters() if p.requires_grad]
+        param_groups = [{"params": self.params_to_optimize}]
         
         self.optimizer = optimizer_cls(
-            params_to_optimize,
+            param_groups,
             lr=self.config.training.learning_rate,
             betas=(self.config.training.adam_beta1, self.config.training.adam_beta2),
             weight_decay=self.config.training.adam_weight_decay,
             eps=self.config.training.adam_epsilon,
+            **optimizer_kwargs,
         )
         
         logger.info("Optimizer setup complete")
@@ -264,22 +652,193 @@ class LoRATrainer:
         train_dataset = LoRADataset(
             data_root=self.config.dataset.train_data_dir,
             tokenizer=self.tokenizer,
-            size=self.config.dataset.resolution,
-            center_crop=self.config.dataset.center_crop,
-            random_flip=self.config.dataset.random_flip,
-            color_jitter=self.config.dataset.color_jitter,
         )
         
+        # The VAE and text encoder are frozen, so encode every image and caption once instead of on every step
+        if self.config.dataset.get("cache_latents", False):
+            self.precompute_latents(train_dataset)
+        if self.config.dataset.get("cache_text_embeddings", False):
+            self.precompute_text_embeddings(train_dataset)
+            
+        batch_sampler = CostBucketBatchSampler(
+            train_dataset.sizes,
+            batch_size=self.config.training.train_batch_size,
+            # The UNet and loss are compiled for a static batch shape; a ragged batch would trigger a recompile
+            drop_last=True,
+            seed=self.config.training.seed or 0,
+        )
+        
+        num_workers = self.config.training.dataloader_num_workers
         self.train_dataloader = torch.utils.data.DataLoader(
             train_dataset,
-            batch_size=self.config.training.train_batch_size,
-            shuffle=True,
-            collate_fn=collate_fn,
-            num_workers=self.config.training.dataloader_num_workers,
+            batch_sampler=batch_sampler,
+            collate_fn=PinnedBatchCollator(self.config.training.train_batch_size),
+            num_workers=num_workers,
+            pin_memory=True,
+            persistent_workers=num_workers > 0,
+            prefetch_factor=4 if num_workers > 0 else None,
         )
         
         logger.info(f"Dataset setup complete. Training samples: {len(train_dataset)}")
         
+    def precompute_latents(self, train_dataset):
+        """Encode every training image with the VAE once and cache the latent distribution in memmapped files.
+
+        The scaled mean is stored as float16 and the log-variance as int8, next to a manifest
+        recording each file's shape, dtype and sha256. A cache whose manifest still matches the
+        dataset and the files on disk is reused; a corrupted or stale one is rebuilt.
+        """
+        cache_dir = Path(self.config.training.output_dir, "latent_cache")
+        mean_path = cache_dir / "latents_mean.npy"
+        logvar_path = cache_dir / "latents_logvar.npy"
+        range_path = cache_dir / "logvar_range.npy"
+        manifest_path = cache_dir / "manifest.json"
+        fingerprint = self._latent_cache_fingerprint(train_dataset)
+        
+        if self.accelerator.is_main_process and not self._latent_cache_is_valid(manifest_path, fingerprint):
+            logger.info("Precomputing VAE latents...")
+            if not self.config.dataset.center_crop or self.config.dataset.random_flip or self.config.dataset.color_jitter:
+                logger.warning("Random crop / flip / color jitter augmentations are frozen into the cached latents")
+                
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            self.vae.to(self.accelerator.device, dtype=self.vae_dtype)
+            
+            vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+            latent_size = self.config.dataset.resolution // vae_scale_factor
+            shape = (len(train_dataset), self.vae.config.latent_channels, latent_size, latent_size)
+            mean_mmap = np.lib.format.open_memmap(mean_path, mode="w+", dtype=np.float16, shape=shape)
+            logvar_mmap = np.lib.format.open_memmap(logvar_path, mode="w+", dtype=np.int8, shape=shape)
+            range_mmap = np.lib.format.open_memmap(range_path, mode="w+", dtype=np.float32, shape=(len(train_dataset), 2))
+            
+            batch_size = self.config.training.train_batch_size
+            scaling_factor = self.vae.config.scaling_factor
+            # No autocast: it would run the fp32 VAE of the fp16 fallback in fp16
+            with torch.inference_mode():
+                for start in range(0, len(train_dataset), batch_size):
+                    end = min(start + batch_size, len(train_dataset))
+                    pixel_values = torch.stack([train_dataset.load_image(i) for i in range(start, end)])
+                    pixel_values = self.gpu_transform(pixel_values.to(self.accelerator.device))
+                    pixel_values = pixel_values.to(self.vae_dtype, memory_format=torch.channels_last)
+                    latent_dist = self.vae.encode(pixel_values).latent_dist
+                    logvar_q, logvar_range = quantize_logvar(latent_dist.logvar.float())
+                    mean_mmap[start:end] = (latent_dist.mean * scaling_factor).half().cpu().numpy()
+                    logvar_mmap[start:end] = logvar_q.cpu().numpy()
+                    range_mmap[start:end] = logvar_range.cpu().numpy()
+                    
+            for mmap in (mean_mmap, logvar_mmap, range_mmap):
+                mmap.flush()
+            del mean_mmap, logvar_mmap, range_mmap
+            
+            manifest = {"fingerprint": fingerprint, "files": {}}
+            for path in (mean_path, logvar_path, range_path):
+                array = np.load(path, mmap_mode="r")
+                manifest["files"][path.name] = {
+                    "shape": list(array.shape),
+                    "dtype": str(array.dtype),
+                    "sha256": sha256_file(path),
+                }
+            manifest_path.write_text(json.dumps(manifest, indent=2))
+            
+            # The VAE is not used again during training
+            self.vae.to("cpu")
+            torch.cuda.empty_cache()
+            
+            logger.info(f"Cached latents to {cache_dir}")
+            
+        self.accelerator.wait_for_everyone()
+        train_dataset.latents_mean = np.load(mean_path, mmap_mode="r")
+        train_dataset.latents_logvar = np.load(logvar_path, mmap_mode="r")
+        train_dataset.logvar_range = np.load(range_path, mmap_mode="r")
+        
+    def _latent_cache_fingerprint(self, train_dataset):
+        """Hash the inputs that determine the latent cache contents."""
+        digest = hashlib.sha256()
+        digest.update(str(self.config.model.pretrained_model_name_or_path).encode())
+        digest.update(str(self.config.dataset.resolution).encode())
+        # Augmentations and the VAE's compute dtype are baked into the cached latents
+        digest.update(
+            f"{self.config.dataset.center_crop}:{self.config.dataset.random_flip}:"
+            f"{self.config.dataset.color_jitter}:{self.vae_dtype}".encode()
+        )
+        for image_file, size in zip(train_dataset.image_files, train_dataset.sizes):
+            digest.update(f"{image_file.name}:{size}".encode())
+        return digest.hexdigest()
+        
+    def _latent_cache_is_valid(self, manifest_path, fingerprint):
+        """Check a latent cache manifest against the dataset and the cached files."""
+        if not manifest_path.exists():
+            return False
+            
+        manifest = json.loads(manifest_path.read_text())
+        if manifest.get("fingerprint") != fingerprint:
+            logger.info("Latent cache was built for a different dataset or model, rebuilding")
+            return False
+            
+        for name, entry in manifest["files"].items():
+            path = manifest_path.parent / name
+            if not path.exists():
+                logger.warning(f"Latent cache file {path} is missing, rebuilding")
+                return False
+            array = np.load(path, mmap_mode="r")
+            if list(array.shape) != entry["shape"] or str(array.dtype) != entry["dtype"] or sha256_file(path) != entry["sha256"]:
+                logger.warning(f"Latent cache file {path} does not match its manifest, rebuilding")
+                return False
+                
+        logger.info(f"Reusing latent cache in {manifest_path.parent}")
+        return True
+        
+    def precompute_text_embeddings(self, train_dataset):
+        """Run the frozen text encoder once per unique caption and cache the hidden states in a memmapped file.
+
+        Samples sharing a caption (after tokenization) share one cached row. The cache is reused
+        while its manifest's fingerprint still matches the model, precision and captions.
+        """
+        logger.info("Precomputing text embeddings...")
+        cache_dir = Path(self.config.training.output_dir, "text_cache")
+        emb_path = cache_dir / "text_emb.npy"
+        manifest_path = cache_dir / "manifest.json"
+        
+        # Deterministic, so every process derives the same sample -> row mapping without communicating
+        unique_ids, inverse = torch.unique(train_dataset.input_ids, dim=0, return_inverse=True)
+        shape = [len(unique_ids), unique_ids.shape[1], self.text_encoder.config.hidden_size]
+        
+        digest = hashlib.sha256()
+        digest.update(str(self.config.model.pretrained_model_name_or_path).encode())
+        digest.update(f"{self.weight_dtype}:{self.config.memory.get('quantize_text_encoder', False)}".encode())
+        digest.update(unique_ids.numpy().tobytes())
+        fingerprint = digest.hexdigest()
+        
+        if self.accelerator.is_main_process:
+            manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+            if emb_path.exists() and manifest.get("fingerprint") == fingerprint and manifest.get("shape") == shape:
+                logger.info(f"Reusing cached text embeddings in {cache_dir}")
+            else:
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                manifest_path.unlink(missing_ok=True)
+                self.text_encoder.to(self.accelerator.device, dtype=self.weight_dtype)
+                emb_mmap = np.lib.format.open_memmap(emb_path, mode="w+", dtype=np.float16, shape=tuple(shape))
+                
+                batch_size = 64
+                with torch.inference_mode():
+                    for start in range(0, len(unique_ids), batch_size):
+                        input_ids = unique_ids[start:start + batch_size].to(self.accelerator.device)
+                        emb_mmap[start:start + len(input_ids)] = self.text_encoder(input_ids)[0].float().cpu().numpy()
+                        
+                emb_mmap.flush()
+                del emb_mmap
+                # Written last, so an interrupted pass is never mistaken for a complete cache
+                manifest_path.write_text(json.dumps({"fingerprint": fingerprint, "shape": shape}))
+                
+            # The text encoder is not used again during training
+            self.text_encoder.to("cpu")
+            torch.cuda.empty_cache()
+            
+        self.accelerator.wait_for_everyone()
+        train_dataset.text_emb = np.load(emb_path, mmap_mode="r")
+        train_dataset.text_emb_index = inverse.numpy()
+        
+        logger.info(f"Cached {len(unique_ids)} unique caption embeddings for {len(train_dataset)} samples in {cache_dir}")
+        
     def setup_lr_scheduler(self):
         """Setup learning rate scheduler."""
         self.lr_scheduler = get_scheduler(
@@ -302,13 +861,19 @@ class LoRATrainer:
         self.setup_lr_scheduler()
         
         # Prepare everything with accelerator
-        self.unet, self.optimizer, self.train_dataloader, self.lr_scheduler = self.accelerator.prepare(
-            self.unet, self.optimizer, self.train_dataloader, self.lr_scheduler
+        self.unet, self.optimizer, self.lr_scheduler = self.accelerator.prepare(
+            self.unet, self.optimizer, self.lr_scheduler
         )
+        # Host-to-device copies are issued by CudaPrefetcher on a side stream instead
+        self.train_dataloader = self.accelerator.prepare_data_loader(self.train_dataloader, device_placement=False)
         
         # Move models to device
-        self.vae.to(self.accelerator.device, dtype=torch.float32)
-        self.text_encoder.to(self.accelerator.device)
+        cache_latents = self.config.dataset.get("cache_latents", False)
+        if not cache_latents:
+            self.vae.to(self.accelerator.device, dtype=self.vae_dtype)
+        cache_text_embeddings = self.config.dataset.get("cache_text_embeddings", False)
+        if not cache_text_embeddings:
+            self.text_encoder.to(self.accelerator.device, dtype=self.weight_dtype)
         
         # Calculate total training steps
         num_update_steps_per_epoch = math.ceil(len(self.train_dataloader) / self.config.training.gradient_accumulation_steps)
@@ -333,10 +898,34 @@ class LoRATrainer:
         
         global_step = 0
         first_epoch = 0
+        log_every = int(self.config.logging.get("log_every", 10))
+        
+        # Hoist per-step config lookups out of the loop; OmegaConf attribute access is comparatively slow
+        device = self.accelerator.device
+        max_train_steps = int(self.config.training.max_train_steps)
+        checkpointing_steps = int(self.config.training.checkpointing_steps)
+        max_grad_norm = self.config.training.max_grad_norm
+        set_grads_to_none = bool(self.config.memory.set_grads_to_none)
+        vae_scaling_factor = self.vae.config.scaling_factor
+        num_train_timesteps = self.noise_scheduler.config.num_train_timesteps
+        
+        # Timesteps are stratified over the whole optimizer step: train_batch_size x processes x accumulation
+        # micro-batches share one permutation of equal-width strata, each taking its own disjoint slice.
+        # The permutation generator is seeded identically on every process so they agree on it.
+        grad_accum = int(self.config.training.gradient_accumulation_steps)
+        num_processes = self.accelerator.num_processes
+        num_strata = int(self.config.training.train_batch_size) * num_processes * grad_accum
+        strata_gen = torch.Generator().manual_seed(self.config.training.seed or 0)
+        process_index = self.accelerator.process_index
+        micro_step = 0
+        
+        # Running loss kept on device and only reduced across processes on logging steps
+        self._loss_sum = torch.zeros((), device=device)
+        self._loss_n = 0
         
         # Training progress bar
         progress_bar = tqdm(
-            range(0, self.config.training.max_train_steps),
+            range(0, max_train_steps),
             initial=global_step,
             desc="Steps",
             disable=not self.accelerator.is_local_main_process,
@@ -345,51 +934,66 @@ class LoRATrainer:
         for epoch in range(first_epoch, self.config.training.num_train_epochs):
             self.unet.train()
             
-            for step, batch in enumerate(self.train_dataloader):
+            for step, batch in enumerate(CudaPrefetcher(self.train_dataloader, device)):
                 with self.accelerator.accumulate(self.unet):
                     # Convert images to latent space
-                    latents = self.vae.encode(batch["pixel_values"].to(dtype=self.vae.dtype)).latent_dist.sample()
-                    latents = latents * self.vae.config.scaling_factor
+                    if cache_latents:
+                        # Resample from the cached (already scaled) latent distribution
+                        latents_mean = batch["latents_mean"].to(device, non_blocking=True).float()
+                        latents_logvar = dequantize_logvar(
+                            batch["latents_logvar"].to(device, non_blocking=True),
+                            batch["logvar_range"].to(device, non_blocking=True),
+                        )
+                        latents_std = torch.exp(0.5 * latents_logvar) * vae_scaling_factor
+                        latents = latents_mean + latents_std * torch.randn_like(latents_std)
+                    else:
+                        pixel_values = self.gpu_transform(batch["pixel_values"].to(device, non_blocking=True))
+                        pixel_values = pixel_values.to(self.vae_dtype, memory_format=torch.channels_last)
+                        latents = self.vae.encode(pixel_values).latent_dist.sample()
+                        # fp32 like the cached branch, matching the fp32 prediction of the prepared UNet in the loss
+                        latents = latents.float() * vae_scaling_factor
+                    latents = latents.contiguous(memory_format=torch.channels_last)
                     
-                    # Sample noise
-                    noise = torch.randn_like(latents)
                     bsz = latents.shape[0]
                     
-                    # Sample a random timestep for each image
-                    timesteps = torch.randint(0, self.noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device)
-                    timesteps = timesteps.long()
+                    # Stratified timestep sampling: one timestep from each of this micro-batch's strata
+                    window_step = micro_step % grad_accum
+                    if window_step == 0:
+                        window_strata = torch.randperm(num_strata, generator=strata_gen)
+                    offset = (window_step * num_processes + process_index) * bsz
+                    strata = window_strata[offset:offset + bsz].to(device, non_blocking=True)
+                    micro_step += 1
+                    timesteps = ((strata + torch.rand(bsz, device=device)) * (num_train_timesteps / num_strata)).long()
+                    timesteps.clamp_(max=num_train_timesteps - 1)
                     
-                    # Add noise to the latents according to the noise magnitude at each timestep
-                    noisy_latents = self.noise_scheduler.add_noise(latents, noise, timesteps)
+                    # Sample noise, add it according to the noise magnitude at each timestep and build the target
+                    noisy_latents, target = self.fused_noise(latents, timesteps)
                     
                     # Get the text embedding for conditioning
-                    encoder_hidden_states = self.text_encoder(batch["input_ids"])[0]
+                    if cache_text_embeddings:
+                        encoder_hidden_states = batch["text_emb"].to(device, non_blocking=True).to(self.weight_dtype)
+                    else:
+                        encoder_hidden_states = self.text_encoder(batch["input_ids"])[0]
                     
                     # Predict the noise residual
-                    model_pred = self.unet(noisy_latents, timesteps, encoder_hidden_states).sample
+                    with self.sdp_context():
+                        model_pred = self.unet(noisy_latents, timesteps, encoder_hidden_states).sample
                     
-                    # Get the target for loss depending on the prediction type
-                    if self.noise_scheduler.config.prediction_type == "epsilon":
-                        target = noise
-                    elif self.noise_scheduler.config.prediction_type == "v_prediction":
-                        target = self.noise_scheduler.get_velocity(latents, noise, timesteps)
-                    else:
-                        raise ValueError(f"Unknown prediction type {self.noise_scheduler.config.prediction_type}")
-                        
-                    loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
+                    # Compute the loss against the target for the scheduler's prediction type
+                    loss = self.compute_loss(model_pred, target, timesteps)
                     
-                    # Gather the losses across all processes for logging
-                    avg_loss = self.accelerator.gather(loss.repeat(self.config.training.train_batch_size)).mean()
+                    # Accumulate the loss on device without a collective
+                    self._loss_sum += loss.detach()
+                    self._loss_n += 1
                     
                     # Backpropagate
                     self.accelerator.backward(loss)
                     if self.accelerator.sync_gradients:
-                        params_to_clip = list(filter(lambda p: p.requires_grad, self.unet.parameters()))
-                        self.accelerator.clip_grad_norm_(params_to_clip, self.config.training.max_grad_norm)
+                        self.accelerator.clip_grad_norm_(self.params_to_optimize, max_grad_norm)
                         
                     self.optimizer.step()
                     self.lr_scheduler.step()
-                    self.optimizer.zero_grad(set_to_none=self.config.memory.set_grads_to_none)
+                    self.optimizer.zero_grad(set_to_none=set_grads_to_none)
                     
                 # Checks if the accelerator has performed an optimization step behind the scenes
                 if self.accelerator.sync_gradients:
@@ -397,31 +1001,69 @@ class LoRATrainer:
                     global_step += 1
                     
                     # Save checkpoint
-                    if global_step % self.config.training.checkpointing_steps == 0:
+                    if global_step % checkpointing_steps == 0:
                         if self.accelerator.is_main_process:
-                            save_path = os.path.join(self.config.training.output_dir, f"checkpoint-{global_step}")
-                            self.accelerator.save_state(save_path)
-                            logger.info(f"Saved state to {save_path}")
+                            self.save_checkpoint(global_step)
                             
-                logs = {"loss": avg_loss.detach().item(), "lr": self.lr_scheduler.get_last_lr()[0]}
-                progress_bar.set_postfix(**logs)
-                self.accelerator.log(logs, step=global_step)
-                
-                if global_step >= self.config.training.max_train_steps:
+                    # Average the loss across processes with a single scalar all-reduce on the logging cadence
+                    if global_step % log_every == 0:
+                        loss_sum = self.accelerator.reduce(self._loss_sum, reduction="sum")
+                        avg_loss = loss_sum / (self.accelerator.num_processes * self._loss_n)
+                        logs = {"loss": avg_loss.item(), "lr": self.lr_scheduler.get_last_lr()[0]}
+                        progress_bar.set_postfix(**logs)
+                        self.accelerator.log(logs, step=global_step)
+                        self._loss_sum.zero_()
+                        self._loss_n = 0
+                        
+                if global_step >= max_train_steps:
                     break
                     
         # Save final LoRA weights
+        if self._save_future is not None:
+            self._save_future.result()
+        self._save_pool.shutdown()
         self.accelerator.wait_for_everyone()
         if self.accelerator.is_main_process:
             self.save_lora_weights()
 
         self.accelerator.end_training()
 
+    def save_checkpoint(self, global_step):
+        """Snapshot the LoRA weights and optimizer/scheduler state to CPU and write them on the save thread."""
+        save_path = os.path.join(self.config.training.output_dir, f"checkpoint-{global_step}")
+        
+        # Bound the disk queue to one checkpoint so snapshots cannot pile up in host memory
+        if self._save_future is not None:
+            self._save_future.result()
+            
+        unet = self.accelerator.unwrap_model(self.unet)
+        unet = unet._orig_mod if is_compiled_module(unet) else unet
+        lora_state = {
+            name: param.detach().to("cpu", non_blocking=True)
+            for name, param in unet.named_parameters()
+            if param.requires_grad
+        }
+        training_state = send_to_device(
+            {"optimizer": self.optimizer.state_dict(), "lr_scheduler": self.lr_scheduler.state_dict(), "step": global_step},
+            "cpu",
+            non_blocking=True,
+        )
+        
+        # The device-to-host copies are asynchronous; the save thread waits on this event instead of the loop
+        copy_done = None
+        if torch.cuda.is_available():
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+            
+        self._save_future = self._save_pool.submit(_write_checkpoint, save_path, lora_state, training_state, copy_done)
+        logger.info(f"Saving state to {save_path} in the background")
+        
     def save_lora_weights(self):
         """Save the trained LoRA weights (Diffusers-native)."""
         logger.info("Saving LoRA weights...")
 
         unet = self.accelerator.unwrap_model(self.unet)
+        unet = unet._orig_mod if is_compiled_module(unet) else unet
         pipeline = StableDiffusionPipeline.from_pretrained(
             self.config.model.pretrained_model_name_or_path,
             unet=unet,
@@ -15,6 +15,9 @@ Usage:
 """
 
 import argparse
+import glob
+import hashlib
+import itertools
 import logging
 import math
 import os
@@ -26,12 +29,13 @@ import json
 import time
 
 import numpy as np
+import pandas as pd
 import torch
 import torch.nn.functional as F
 import torch.utils.checkpoint
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import ProjectConfiguration, set_seed
+from accelerate.utils import DataLoaderConfiguration, DistributedDataParallelKwargs, ProjectConfiguration, set_seed
 from datasets import load_dataset
 from diffusers import (
     AutoencoderKL,
@@ -45,15 +49,19 @@ from diffusers.optimization import get_scheduler
 from diffusers.training_utils import EMAModel
 from diffusers.utils import check_min_version, is_wandb_available
 from diffusers.utils.import_utils import is_xformers_available
-from diffusers.models.attention_processor import LoRAAttnProcessor
+from diffusers.utils.torch_utils import is_compiled_module
+from diffusers.models.attention_processor import AttnProcessor2_0, LoRAAttnProcessor
 from huggingface_hub import create_repo, upload_folder
+from packaging import version
 import yaml
 from PIL import Image
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset, get_worker_info
 from torchvision import transforms
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
 
+from scripts.gpu_decode import decode_jpeg_batch, read_jpeg_bytes
+
 # Configure logging
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -76,6 +84,7 @@ class LexiGraphDataset(Dataset):
         center_crop: bool = False,
         random_flip: bool = False,
         color_jitter: bool = False,
+        gpu_decode: bool = False,
     ):
         self.data_root = Path(data_root)
         self.tokenizer = tokenizer
@@ -83,6 +92,7 @@ class LexiGraphDataset(Dataset):
         self.center_crop = center_crop
         self.random_flip = random_flip
         self.color_jitter = color_jitter
+        self.gpu_decode = gpu_decode
         
         # Load images and captions
         self.images_dir = self.data_root / 'images'
@@ -91,66 +101,285 @@ class LexiGraphDataset(Dataset):
         if not self.images_dir.exists() or not self.captions_dir.exists():
             raise ValueError(f"Images or captions directory doesn't exist in {data_root}")
             
-        self.image_files = list(self.images_dir.glob('*.jpg')) + list(self.images_dir.glob('*.jpeg'))
-        self.image_files = sorted(self.image_files)
-        
-        # Load captions
-        self.captions = []
-        for image_file in self.image_files:
-            caption_file = self.captions_dir / f"{image_file.stem}.txt"
-            if caption_file.exists():
-                with open(caption_file, 'r', encoding='utf-8') as f:
-                    caption = f.read().strip()
-                self.captions.append(caption)
-            else:
-                self.captions.append(f"A photo of {image_file.stem}")
+        # File listing and captions come from a cached index instead of globbing and reading N caption files
+        self.df = self._build_or_load_index()
+        self.image_files = [self.images_dir / name for name in self.df["image"]]
+        self.captions = self.df["caption"].tolist()
                 
+        # Tokenize every caption once so __getitem__ is a plain tensor slice
+        self.input_ids = self.tokenizer(
+            self.captions,
+            truncation=True,
+            padding="max_length",
+            max_length=self.tokenizer.model_max_length,
+            return_tensors="pt",
+        ).input_ids
+        
         # Image transforms
         self.image_transforms = transforms.Compose([
             transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR),
             transforms.CenterCrop(size) if center_crop else transforms.RandomCrop(size),
             transforms.RandomHorizontalFlip() if random_flip else transforms.Lambda(lambda x: x),
             transforms.ColorJitter(0.1, 0.1) if color_jitter else transforms.Lambda(lambda x: x),
-            transforms.ToTensor(),
-            transforms.Normalize([0.5], [0.5]),
+            # Stay uint8; scaling to [-1, 1] happens batched on the GPU (see `normalize_pixel_values`)
+            transforms.PILToTensor(),
+        ])
+        
+        # Same augmentations applied to decoded uint8 tensors on the GPU
+        self.tensor_transforms = transforms.Compose([
+            transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR, antialias=True),
+            transforms.CenterCrop(size) if center_crop else transforms.RandomCrop(size),
+            transforms.RandomHorizontalFlip() if random_flip else transforms.Lambda(lambda x: x),
+            transforms.ColorJitter(0.1, 0.1) if color_jitter else transforms.Lambda(lambda x: x),
         ])
         
         logger.info(f"Loaded {len(self.image_files)} images from {data_root}")
         
+    def _build_or_load_index(self) -> pd.DataFrame:
+        """Load `data_root/index.parquet`, rebuilding it when any image or caption file changed.
+
+        The index stores each caption file's mtime and size, so captions edited in place are
+        picked up. Checking it costs one directory walk each for images and captions, with no
+        caption files opened. A read-only `data_root` keeps the rebuilt index in memory.
+        """
+        index_path = self.data_root / "index.parquet"
+        
+        with os.scandir(self.images_dir) as entries:
+            image_names = sorted(
+                entry.name for entry in entries
+                if entry.is_file() and entry.name.lower().endswith(('.jpg', '.jpeg'))
+            )
+        with os.scandir(self.captions_dir) as entries:
+            caption_stats = {
+                entry.name: entry.stat() for entry in entries
+                if entry.is_file() and entry.name.endswith('.txt')
+            }
+            
+        # Missing captions are stamped (0, -1) and fall back to a generated caption
+        caption_names = [Path(name).with_suffix('.txt').name for name in image_names]
+        caption_mtimes = [caption_stats[name].st_mtime_ns if name in caption_stats else 0 for name in caption_names]
+        caption_sizes = [caption_stats[name].st_size if name in caption_stats else -1 for name in caption_names]
+        
+        if index_path.exists():
+            df = pd.read_parquet(index_path, memory_map=True)
+            if (
+                {"caption_mtime_ns", "caption_size"}.issubset(df.columns)
+                and df["image"].tolist() == image_names
+                and df["caption_mtime_ns"].tolist() == caption_mtimes
+                and df["caption_size"].tolist() == caption_sizes
+            ):
+                return df
+                
+        captions = []
+        for image_name, caption_name in zip(image_names, caption_names):
+            if caption_name in caption_stats:
+                captions.append((self.captions_dir / caption_name).read_text(encoding='utf-8').strip())
+            else:
+                captions.append(f"A photo of {Path(image_name).stem}")
+                
+        df = pd.DataFrame({
+            "image": image_names,
+            "caption": captions,
+            "caption_mtime_ns": caption_mtimes,
+            "caption_size": caption_sizes,
+        })
+        # Write then rename so a reader never sees a partial index
+        tmp_path = index_path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            logger.warning(f"Could not write {index_path} ({e}); using an in-memory index")
+        return df
+        
     def __len__(self):
         return len(self.image_files)
         
+    def decode_images(self, jpeg_bytes, device):
+        """Decode a batch of raw JPEG bytes with nvJPEG on `device` and apply the training transforms."""
+        return decode_jpeg_batch(jpeg_bytes, self.tensor_transforms, device)
+        
     def __getitem__(self, index):
-        # Load and process image
-        image = Image.open(self.image_files[index]).convert("RGB")
-        image = self.image_transforms(image)
+        if self.gpu_decode:
+            # Only the compressed bytes cross to the GPU; decoding happens there with nvJPEG
+            return {
+                "jpeg_bytes": read_jpeg_bytes(self.image_files[index]),
+                "input_ids": self.input_ids[index],
+            }
+            
+        # Load and process image; draft() lets libjpeg decode at a reduced DCT scale that still covers `size`
+        image = Image.open(self.image_files[index])
+        image.draft("RGB", (self.size, self.size))
+        image = self.image_transforms(image.convert("RGB"))
+        
+        return {
+            "pixel_values": image,
+            "input_ids": self.input_ids[index],
+        }
+
+class LexiGraphLatentDataset(Dataset):
+    """Dataset yielding precomputed VAE latent distributions and text embeddings.
+
+    Each sample is a `{image name}.pt` file written by `LexiGraphTrainer.precompute_latents`
+    holding the fp16 latent distribution parameters (mean and logvar, concatenated on the
+    channel axis, so a fresh latent can be sampled every epoch) and the fp16 text encoder
+    hidden states. Files are memory-mapped on load.
+    """
+    
+    def __init__(self, cache_files):
+        self.cache_files = list(cache_files)
         
-        # Process caption
-        caption = self.captions[index]
+    def __len__(self):
+        return len(self.cache_files)
+        
+    def __getitem__(self, index):
+        return torch.load(self.cache_files[index], mmap=True, weights_only=True)
+
+class LexiGraphWebDataset(IterableDataset):
+    """Streaming dataset over webdataset tar shards of `jpg`/`txt` sample pairs.
+
+    Shards are read sequentially instead of opening one small file per sample. Every rank
+    resamples shards independently and shuffles within a sample buffer, so an epoch is
+    `num_samples // world_size` samples split evenly across dataloader workers.
+    """
+    
+    def __init__(
+        self,
+        shards: str,
+        tokenizer,
+        num_samples: int,
+        size: int = 512,
+        center_crop: bool = False,
+        random_flip: bool = False,
+        color_jitter: bool = False,
+        shuffle_buffer: int = 1000,
+        world_size: int = 1,
+    ):
+        try:
+            import webdataset as wds
+        except ImportError:
+            raise ImportError("To train from tar shards, please install webdataset")
+            
+        urls = sorted(glob.glob(shards))
+        if not urls:
+            raise ValueError(f"No shards match {shards}")
+            
+        self.tokenizer = tokenizer
+        self.num_samples = num_samples // world_size
+        self.image_transforms = transforms.Compose([
+            transforms.Resize(size, interpolation=transforms.InterpolationMode.BILINEAR),
+            transforms.CenterCrop(size) if center_crop else transforms.RandomCrop(size),
+            transforms.RandomHorizontalFlip() if random_flip else transforms.Lambda(lambda x: x),
+            transforms.ColorJitter(0.1, 0.1) if color_jitter else transforms.Lambda(lambda x: x),
+            transforms.PILToTensor(),
+        ])
+        
+        self.pipeline = (
+            wds.WebDataset(urls, resampled=True, shardshuffle=True)
+            .shuffle(shuffle_buffer)
+            .decode("pil")
+            .to_tuple("jpg;jpeg", "txt")
+            .map(self._transform_sample)
+        )
+        
+        logger.info(f"Streaming {self.num_samples} samples per process from {len(urls)} shards")
+        
+    def __len__(self):
+        return self.num_samples
+        
+    def _transform_sample(self, sample):
+        image, caption = sample
         input_ids = self.tokenizer(
-            caption,
+            caption.strip(),
             truncation=True,
             padding="max_length",
             max_length=self.tokenizer.model_max_length,
             return_tensors="pt",
         ).input_ids[0]
-        
         return {
-            "pixel_values": image,
+            "pixel_values": self.image_transforms(image.convert("RGB")),
             "input_ids": input_ids,
         }
+        
+    def __iter__(self):
+        # The resampled stream is endless; each worker yields its share of one epoch
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        return itertools.islice(iter(self.pipeline), math.ceil(self.num_samples / num_workers))
+
+def freeze_unfused_projections(unet):
+    """Freeze the separate Q/K/V projections that a fused to_qkv / to_kv projection replaced."""
+    for module in unet.modules():
+        if not getattr(module, "fused_projections", False):
+            continue
+        replaced = [module.to_k, module.to_v] if module.is_cross_attention else [module.to_q, module.to_k, module.to_v]
+        for linear in replaced:
+            linear.requires_grad_(False)
+
+def unfuse_trained_projections(unet):
+    """Copy trained fused to_qkv / to_kv weights back into to_q/to_k/to_v and drop the fused layers."""
+    for module in unet.modules():
+        if not getattr(module, "fused_projections", False):
+            continue
+        if module.is_cross_attention:
+            fused_name, targets = "to_kv", [module.to_k, module.to_v]
+        else:
+            fused_name, targets = "to_qkv", [module.to_q, module.to_k, module.to_v]
+        fused = getattr(module, fused_name)
+        
+        sizes = [linear.out_features for linear in targets]
+        with torch.no_grad():
+            for linear, weight in zip(targets, fused.weight.split(sizes)):
+                linear.weight.copy_(weight)
+            if fused.bias is not None:
+                for linear, bias in zip(targets, fused.bias.split(sizes)):
+                    linear.bias.copy_(bias)
+                    
+        delattr(module, fused_name)
+        module.fused_projections = False
+    unet.set_attn_processor(AttnProcessor2_0())
+
+def normalize_pixel_values(pixel_values, dtype=torch.float32):
+    """Scale a uint8 image batch to [-1, 1] in `dtype`."""
+    return pixel_values.to(dtype).div_(127.5).sub_(1.0)
 
 def collate_fn(examples):
-    """Collate function for LexiGraph dataset."""
-    pixel_values = torch.stack([example["pixel_values"] for example in examples])
-    pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
+    """Collate function for LexiGraph datasets."""
+    batch = {}
+    for key in examples[0]:
+        if key == "jpeg_bytes":
+            # Raw bytes stay as numpy arrays so they are not moved off the CPU before nvJPEG decoding
+            batch[key] = [example[key] for example in examples]
+        else:
+            # Fixed-shape tensors (pixel_values stay uint8; float conversion happens on the GPU)
+            batch[key] = torch.stack([example[key] for example in examples])
+    return batch
+
+class InBackwardOptimizers:
+    """Checkpointable view of the per-parameter optimizers installed by `_apply_optimizer_in_backward`."""
     
-    input_ids = torch.stack([example["input_ids"] for example in examples])
+    def __init__(self, params):
+        self.optimizers = [optimizer for param in params for optimizer in param._in_backward_optimizers]
+        
+    def state_dict(self):
+        return {"optimizers": [optimizer.state_dict() for optimizer in self.optimizers]}
+        
+    def load_state_dict(self, state_dict):
+        if len(state_dict["optimizers"]) != len(self.optimizers):
+            raise ValueError("Checkpoint was saved with a different set of trainable parameters")
+        for optimizer, optimizer_state in zip(self.optimizers, state_dict["optimizers"]):
+            optimizer.load_state_dict(optimizer_state)
+
+class UNetStep(torch.nn.Module):
+    """Tensor-in / tensor-out view of the UNet forward, as `torch.cuda.make_graphed_callables` requires."""
     
-    return {
-        "pixel_values": pixel_values,
-        "input_ids": input_ids,
-    }
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+        
+    def forward(self, sample, timestep, encoder_hidden_states):
+        # Cast inside the graph so the prediction matches the fp32 outputs of the prepared (autocast) UNet
+        return self.unet(sample, timestep, encoder_hidden_states, return_dict=False)[0].float()
 
 class LexiGraphTrainer:
     """Production-ready trainer for LexiGraph models."""
@@ -172,11 +401,31 @@ class LexiGraphTrainer:
             logging_dir=logging_dir
         )
         
+        # bf16 keeps fp32 range, so no grad scaler is needed; default to it whenever the GPU supports it.
+        # Set training.mixed_precision to "fp16" or "no" to override.
+        mixed_precision = self.config['training'].get('mixed_precision')
+        bf16_supported = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+        if mixed_precision is None:
+            mixed_precision = 'bf16' if bf16_supported else 'fp16'
+        elif mixed_precision == 'bf16' and not bf16_supported:
+            logger.warning("bf16 is not supported on this device, falling back to fp16")
+            mixed_precision = 'fp16'
+        
+        # Let DDP alias gradients into its buckets and reuse the graph analysis across steps
+        ddp_kwargs = DistributedDataParallelKwargs(
+            gradient_as_bucket_view=True,
+            static_graph=True,
+            find_unused_parameters=False,
+        )
+        
         self.accelerator = Accelerator(
             gradient_accumulation_steps=self.config['training']['gradient_accumulation_steps'],
-            mixed_precision=self.config['training'].get('mixed_precision', 'fp16'),
+            mixed_precision=mixed_precision,
             log_with=self.config['logging'].get('report_to', 'tensorboard'),
             project_config=accelerator_project_config,
+            kwargs_handlers=[ddp_kwargs],
+            # Prepared dataloaders copy their pinned batches to the device asynchronously
+            dataloader_config=DataLoaderConfiguration(non_blocking=True),
         )
         
         # Set seed for reproducibility
@@ -227,6 +476,7 @@ class LexiGraphTrainer:
         
         # Setup training method (LoRA or DreamBooth)
         training_method = self.config['training'].get('method', 'lora')
+        self.lora_attn_procs = False
         
         if training_method == 'lora':
             self._setup_lora()
@@ -236,17 +486,61 @@ class LexiGraphTrainer:
         else:
             raise ValueError(f"Unknown training method: {training_method}")
         
-        # Enable memory efficient attention if available
-        if is_xformers_available() and self.config['training'].get('enable_xformers_memory_efficient_attention', True):
+        # PyTorch SDPA picks FlashAttention-2 / memory-efficient kernels by itself; xformers is only a fallback.
+        # The diffusers LoRA fallback trains attention processors, which must not be replaced.
+        if hasattr(F, "scaled_dot_product_attention"):
+            torch.backends.cuda.enable_flash_sdp(True)
+            torch.backends.cuda.enable_mem_efficient_sdp(True)
+            if not self.lora_attn_procs:
+                self.unet.set_attn_processor(AttnProcessor2_0())
+        elif is_xformers_available() and self.config['training'].get('enable_xformers_memory_efficient_attention', True):
             self.unet.enable_xformers_memory_efficient_attention()
-            if training_method == 'dreambooth':
-                self.text_encoder.enable_xformers_memory_efficient_attention()
+            
+        # Full fine-tuning trains the projection weights directly, so Q/K/V (self-attention) and K/V
+        # (cross-attention) can run as one wide GEMM. PEFT LoRA adapters sit on the separate to_q/to_k/to_v
+        # layers and would be bypassed by the fused projection, so LoRA keeps them unfused.
+        if (
+            training_method == 'dreambooth'
+            and hasattr(F, "scaled_dot_product_attention")
+            and self.config['training'].get('fuse_qkv_projections', True)
+            and hasattr(self.unet, "fuse_qkv_projections")
+        ):
+            from diffusers.models.attention_processor import FusedAttnProcessor2_0
+            
+            self.unet.fuse_qkv_projections()
+            self.unet.set_attn_processor(FusedAttnProcessor2_0())
+            freeze_unfused_projections(self.unet)
             
         # Enable gradient checkpointing
         if self.config['training'].get('gradient_checkpointing', True):
             self.unet.enable_gradient_checkpointing()
             if training_method == 'dreambooth':
                 self.text_encoder.gradient_checkpointing_enable()
+                
+        # channels_last for the conv-heavy UNet and VAE; latents from _encode_batch are produced in the same layout
+        self.unet.to(memory_format=torch.channels_last)
+        self.vae.to(memory_format=torch.channels_last)
+        
+        # Compile before accelerator.prepare so DDP wraps the compiled module. reduce-overhead captures
+        # CUDA graphs, which needs static shapes: keep train_batch_size and resolution fixed.
+        if self.config['training'].get('torch_compile', True) and version.parse(torch.__version__) >= version.parse("2.1"):
+            self.unet = torch.compile(self.unet, mode="reduce-overhead", dynamic=False)
+            
+        # Opt-in manual CUDA graph capture of the UNet forward + backward (see `_capture_unet_graph`) for eager
+        # runs. Compiled UNets already replay CUDA graphs, DDP needs its own forward to all-reduce gradients, and
+        # optimizer-in-backward hooks would step during the capture warmup.
+        self.cuda_graphs = (
+            self.config['training'].get('cuda_graphs', False)
+            and torch.cuda.is_available()
+            and not is_compiled_module(self.unet)
+            and self.accelerator.num_processes == 1
+            and not self.config['training'].get('optimizer_in_backward', False)
+        )
+        if self.config['training'].get('cuda_graphs', False) and not self.cuda_graphs:
+            logger.warning(
+                "cuda_graphs needs a single CUDA process with torch_compile and optimizer_in_backward off; skipping capture"
+            )
+        self.unet_step = None
             
         logger.info("Models loaded successfully")
         
@@ -284,6 +578,7 @@ class LexiGraphTrainer:
                 lora_attn_procs[name] = LoRAAttnProcessor()
 
             self.unet.set_attn_processor(lora_attn_procs)
+            self.lora_attn_procs = True
             logger.info("Diffusers LoRA setup complete")
         
     def _setup_dreambooth(self):
@@ -310,60 +605,155 @@ class LexiGraphTrainer:
         if self.config['training'].get('use_8bit_adam', False):
             try:
                 import bitsandbytes as bnb
-                optimizer_cls = bnb.optim.AdamW8bit
+                # Paged optimizer state spills to CPU-mapped pages instead of OOMing on spikes
+                optimizer_cls = bnb.optim.PagedAdamW8bit
             except ImportError:
                 raise ImportError("To use 8-bit Adam, please install bitsandbytes")
         else:
             optimizer_cls = torch.optim.AdamW
             
-        self.optimizer = optimizer_cls(
-            params_to_optimize,
+        optimizer_kwargs = dict(
             lr=self.config['training']['learning_rate'],
             betas=(self.config['training'].get('adam_beta1', 0.9), 
                    self.config['training'].get('adam_beta2', 0.999)),
             weight_decay=self.config['training'].get('adam_weight_decay', 1e-2),
             eps=self.config['training'].get('adam_epsilon', 1e-08),
         )
+        if optimizer_cls is torch.optim.AdamW:
+            # One fused kernel per step over every trainable tensor, LoRA or full. Nothing has been prepared
+            # yet, so move the trained models here: fused=True refuses parameters that are not on CUDA.
+            if self.config.get('optimizer', {}).get('fused', True) and torch.cuda.is_available():
+                self.unet.to(self.accelerator.device)
+                if training_method == 'dreambooth':
+                    self.text_encoder.to(self.accelerator.device)
+                optimizer_kwargs['fused'] = True
+            else:
+                optimizer_kwargs['foreach'] = True
+        self.optimizer = optimizer_cls(params_to_optimize, **optimizer_kwargs)
+        
+        # Optionally step each parameter as soon as its gradient is ready (after its DDP bucket all-reduce),
+        # overlapping the optimizer with the rest of backward. The regular optimizer above then only carries
+        # the learning rate schedule, which is copied into the per-parameter optimizers every step.
+        self.optimizer_in_backward = self.config['training'].get('optimizer_in_backward', False)
+        if self.optimizer_in_backward:
+            if self.config['training']['gradient_accumulation_steps'] != 1:
+                raise ValueError("optimizer_in_backward requires gradient_accumulation_steps: 1")
+            if self.accelerator.mixed_precision not in ("bf16", "no"):
+                # fp16 gradients are loss-scaled and only unscaled / inf-checked by the GradScaler at optimizer.step()
+                raise ValueError(
+                    f"optimizer_in_backward requires mixed_precision 'bf16' or 'no', got '{self.accelerator.mixed_precision}'"
+                )
+            if self.config['training'].get('max_grad_norm'):
+                logger.warning("Gradient clipping is skipped with optimizer_in_backward; gradients are consumed during backward")
+                
+            # Private PyTorch API (torch.distributed.optim); fail clearly if a release drops it
+            try:
+                from torch.distributed.optim import _apply_optimizer_in_backward
+            except ImportError:
+                raise ImportError("optimizer_in_backward is not supported by this PyTorch version")
+            
+            _apply_optimizer_in_backward(optimizer_cls, params_to_optimize, optimizer_kwargs=optimizer_kwargs)
+            self.params_to_optimize = params_to_optimize
+            # The per-parameter optimizers hold the Adam moments, which accelerator.save_state does not see
+            self.in_backward_optimizers = InBackwardOptimizers(params_to_optimize)
+            self.accelerator.register_for_checkpointing(self.in_backward_optimizers)
         
         logger.info(f"Optimizer setup complete with {len(params_to_optimize)} trainable parameters")
 
     def setup_dataloader(self):
         """Setup training and validation dataloaders."""
-        train_dataset = LexiGraphDataset(
-            data_root=self.config['dataset']['train_data_dir'],
-            tokenizer=self.tokenizer,
-            size=self.config['dataset'].get('resolution', 512),
-            center_crop=self.config['dataset'].get('center_crop', False),
-            random_flip=self.config['dataset'].get('random_flip', True),
-            color_jitter=self.config['dataset'].get('color_jitter', False),
+        # nvJPEG decoding needs a CUDA device; otherwise images are decoded by PIL in the workers
+        self.gpu_decode = self.config['dataset'].get('gpu_decode', False) and torch.cuda.is_available()
+        
+        shards = self.config['dataset'].get('shards')
+        if shards:
+            # Sequential tar-shard streaming; images are decoded by PIL in the workers
+            train_dataset = LexiGraphWebDataset(
+                shards=shards,
+                tokenizer=self.tokenizer,
+                num_samples=self.config['dataset']['num_samples'],
+                size=self.config['dataset'].get('resolution', 512),
+                center_crop=self.config['dataset'].get('center_crop', False),
+                random_flip=self.config['dataset'].get('random_flip', True),
+                color_jitter=self.config['dataset'].get('color_jitter', False),
+                shuffle_buffer=self.config['dataset'].get('shuffle_buffer', 1000),
+                world_size=self.accelerator.num_processes,
+            )
+        else:
+            # The main process builds index.parquet; the other ranks then load it instead of rebuilding it
+            with self.accelerator.main_process_first():
+                train_dataset = LexiGraphDataset(
+                    data_root=self.config['dataset']['train_data_dir'],
+                    tokenizer=self.tokenizer,
+                    size=self.config['dataset'].get('resolution', 512),
+                    center_crop=self.config['dataset'].get('center_crop', False),
+                    random_flip=self.config['dataset'].get('random_flip', True),
+                    color_jitter=self.config['dataset'].get('color_jitter', False),
+                    gpu_decode=self.gpu_decode,
+                )
+
+        # In LoRA mode the VAE and text encoder are frozen, so encode every sample once and train from the cache
+        # A random crop, flip or color jitter would be frozen into the cache, so caching needs deterministic preprocessing
+        self.cache_latents = (
+            self.config['training'].get('method', 'lora') == 'lora'
+            and self.config['dataset'].get('cache_latents', False)
+            and not shards
         )
-
+        if self.cache_latents and (
+            not train_dataset.center_crop or train_dataset.random_flip or train_dataset.color_jitter
+        ):
+            logger.warning(
+                "cache_latents requires center_crop and no random_flip / color_jitter; encoding images every step instead"
+            )
+            self.cache_latents = False
+        if self.cache_latents:
+            train_dataset = self.precompute_latents(train_dataset, "train")
+        self.train_dataset = train_dataset
+            
+        # Decode in worker processes by default so JPEG decode overlaps GPU compute; 0 keeps loading in-process
+        num_workers = self.config['training'].get('dataloader_num_workers')
+        if num_workers is None:
+            num_workers = min(8, os.cpu_count() or 1)
+        prefetch_factor = self.config['training'].get('dataloader_prefetch_factor', 4) if num_workers > 0 else None
+        
         self.train_dataloader = DataLoader(
             train_dataset,
             batch_size=self.config['training']['train_batch_size'],
-            shuffle=True,
+            shuffle=not shards,  # Shard streams shuffle through their sample buffer
+            drop_last=self.cuda_graphs,  # Captured graphs only replay the full batch shape
             collate_fn=collate_fn,
-            num_workers=self.config['training'].get('dataloader_num_workers', 0),
+            num_workers=num_workers,
+            pin_memory=True,
+            persistent_workers=num_workers > 0,
+            prefetch_factor=prefetch_factor,
         )
 
         # Setup validation dataloader if validation data exists
         val_data_dir = self.config['dataset'].get('validation_data_dir')
         if val_data_dir and Path(val_data_dir).exists():
-            val_dataset = LexiGraphDataset(
-                data_root=val_data_dir,
-                tokenizer=self.tokenizer,
-                size=self.config['dataset'].get('resolution', 512),
-                center_crop=True,  # No augmentation for validation
-                random_flip=False,
-                color_jitter=False,
-            )
+            with self.accelerator.main_process_first():
+                val_dataset = LexiGraphDataset(
+                    data_root=val_data_dir,
+                    tokenizer=self.tokenizer,
+                    size=self.config['dataset'].get('resolution', 512),
+                    center_crop=True,  # No augmentation for validation
+                    random_flip=False,
+                    color_jitter=False,
+                    gpu_decode=self.gpu_decode,
+                )
+            if self.cache_latents:
+                val_dataset = self.precompute_latents(val_dataset, "validation")
+            self.val_dataset = val_dataset
 
             self.val_dataloader = DataLoader(
                 val_dataset,
                 batch_size=self.config['training'].get('eval_batch_size', 1),
                 shuffle=False,
                 collate_fn=collate_fn,
-                num_workers=self.config['training'].get('dataloader_num_workers', 0),
+                num_workers=num_workers,
+                pin_memory=True,
+                persistent_workers=num_workers > 0,
+                prefetch_factor=prefetch_factor,
             )
         else:
             self.val_dataloader = None
@@ -371,7 +761,164 @@ class LexiGraphTrainer:
         logger.info(f"Training dataloader setup with {len(train_dataset)} samples")
         if self.val_dataloader:
             logger.info(f"Validation dataloader setup with {len(val_dataset)} samples")
-
+            
+        if self.cache_latents:
+            # Neither frozen model is needed on the GPU again
+            self.vae.to("cpu")
+            self.text_encoder.to("cpu")
+            torch.cuda.empty_cache()
+
+    def precompute_latents(self, dataset: LexiGraphDataset, split: str) -> LexiGraphLatentDataset:
+        """Encode every sample of `dataset` with the VAE and text encoder once into `output_dir/latent_cache/{split}`.
+
+        The cache is reused across runs while its manifest's fingerprint still matches the model,
+        resolution, precision and dataset index, and every cached file is present.
+        """
+        cache_dir = Path(self.config['training']['output_dir']) / "latent_cache" / split
+        manifest_path = cache_dir / "manifest.json"
+        # Full file names, so a.jpg and a.jpeg do not share a cache entry
+        cache_files = [cache_dir / f"{image_file.name}.pt" for image_file in dataset.image_files]
+        fingerprint = self._latent_cache_fingerprint(dataset)
+        
+        if self.accelerator.is_main_process and not self._latent_cache_is_valid(manifest_path, fingerprint, cache_files):
+            logger.info(f"Precomputing latents and text embeddings for {dataset.data_root}...")
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            # The manifest is written last, so an interrupted pass is never mistaken for a complete cache
+            manifest_path.unlink(missing_ok=True)
+            self.vae.to(self.accelerator.device)
+            self.text_encoder.to(self.accelerator.device)
+            
+            loader = DataLoader(
+                dataset,
+                batch_size=self.config['training']['train_batch_size'],
+                shuffle=False,
+                collate_fn=collate_fn,
+                num_workers=self.config['training'].get('dataloader_num_workers') or 0,
+                pin_memory=True,
+            )
+            
+            index = 0
+            with torch.inference_mode(), self.accelerator.autocast():
+                for batch in tqdm(loader, desc="Caching latents"):
+                    if "jpeg_bytes" in batch:
+                        pixel_values = dataset.decode_images(batch["jpeg_bytes"], self.accelerator.device)
+                    else:
+                        pixel_values = batch["pixel_values"].to(self.accelerator.device, non_blocking=True)
+                    pixel_values = normalize_pixel_values(pixel_values, self.vae.dtype)
+                    input_ids = batch["input_ids"].to(self.accelerator.device, non_blocking=True)
+                    
+                    latent_parameters = self.vae.encode(pixel_values).latent_dist.parameters.half().cpu()
+                    encoder_hidden_states = self.text_encoder(input_ids)[0].half().cpu()
+                    
+                    for i in range(len(latent_parameters)):
+                        torch.save(
+                            {
+                                "latent_parameters": latent_parameters[i].clone(),
+                                "encoder_hidden_states": encoder_hidden_states[i].clone(),
+                            },
+                            cache_files[index],
+                        )
+                        index += 1
+                        
+            manifest_path.write_text(json.dumps({"fingerprint": fingerprint, "num_files": len(cache_files)}))
+        elif self.accelerator.is_main_process:
+            logger.info(f"Reusing cached latents in {cache_dir}")
+            
+        self.accelerator.wait_for_everyone()
+        return LexiGraphLatentDataset(cache_files)
+        
+    def _latent_cache_fingerprint(self, dataset: LexiGraphDataset) -> str:
+        """Hash everything that determines the contents of a latent cache."""
+        digest = hashlib.sha256()
+        digest.update(
+            f"{self.config['model']['pretrained_model_name_or_path']}:{dataset.size}:"
+            f"{self.accelerator.mixed_precision}:{self.tokenizer.model_max_length}".encode()
+        )
+        # The index's caption mtimes and sizes change whenever a caption is edited
+        for row in dataset.df[["image", "caption_mtime_ns", "caption_size"]].itertuples(index=False):
+            digest.update(f"{row.image}:{row.caption_mtime_ns}:{row.caption_size}\n".encode())
+        return digest.hexdigest()
+        
+    def _latent_cache_is_valid(self, manifest_path: Path, fingerprint: str, cache_files) -> bool:
+        """Check a latent cache manifest against the current fingerprint and the files on disk."""
+        if not manifest_path.exists():
+            return False
+        manifest = json.loads(manifest_path.read_text())
+        if manifest.get("fingerprint") != fingerprint or manifest.get("num_files") != len(cache_files):
+            logger.info("Latent cache was built for a different dataset or model, rebuilding")
+            return False
+        with os.scandir(manifest_path.parent) as entries:
+            present = {entry.name for entry in entries}
+        if any(path.name not in present for path in cache_files):
+            logger.warning(f"Latent cache in {manifest_path.parent} is incomplete, rebuilding")
+            return False
+        return True
+        
+    def _encode_batch(self, batch, dataset):
+        """Return scaled latents and text conditioning, from the cache or by running the frozen encoders."""
+        device = self.accelerator.device
+        scaling_factor = self.vae.config.scaling_factor
+        
+        if "latent_parameters" in batch:
+            # Sample a fresh latent from the cached distribution, as latent_dist.sample() would
+            mean, logvar = batch["latent_parameters"].to(device, non_blocking=True).float().chunk(2, dim=1)
+            std = torch.exp(0.5 * logvar.clamp(-30.0, 20.0))
+            latents = (mean + std * torch.randn_like(std)) * scaling_factor
+            encoder_hidden_states = batch["encoder_hidden_states"].to(device, non_blocking=True).float()
+            return latents.contiguous(memory_format=torch.channels_last), encoder_hidden_states
+            
+        if "jpeg_bytes" in batch:
+            pixel_values = dataset.decode_images(batch["jpeg_bytes"], device)
+        else:
+            # Pinned batches copy asynchronously; no-ops if the batch is already on device
+            pixel_values = batch["pixel_values"].to(device, non_blocking=True)
+        pixel_values = normalize_pixel_values(pixel_values, self.vae.dtype)
+        pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
+        input_ids = batch["input_ids"].to(device, non_blocking=True)
+        
+        # Run the encoders under the same autocast policy as the prepared UNet. The frozen VAE needs no
+        # autograd bookkeeping at all; the clone turns its inference tensor back into one the UNet can
+        # save for backward.
+        with self.accelerator.autocast():
+            with torch.inference_mode():
+                latents = self.vae.encode(pixel_values).latent_dist.sample() * scaling_factor
+            encoder_hidden_states = self.text_encoder(input_ids)[0]
+        return latents.clone(memory_format=torch.channels_last), encoder_hidden_states
+
+    def _capture_unet_graph(self):
+        """Capture the UNet forward and backward for fixed-shape batches as CUDA graphs in `self.unet_step`."""
+        device = self.accelerator.device
+        batch_size = self.config['training']['train_batch_size']
+        latent_size = self.config['dataset'].get('resolution', 512) // (2 ** (len(self.vae.config.block_out_channels) - 1))
+        
+        # Recomputation during backward cannot be replayed from a captured graph
+        self.unet.disable_gradient_checkpointing()
+        self.unet.to(device)
+        # from_pretrained leaves models in eval(); dropout (e.g. LoRA dropout) must be recorded into the graph
+        self.unet.train()
+        if self.config['training'].get('method', 'lora') == 'dreambooth':
+            self.text_encoder.train()
+        
+        sample_args = (
+            torch.randn(
+                batch_size, self.unet.config.in_channels, latent_size, latent_size, device=device
+            ).contiguous(memory_format=torch.channels_last),
+            torch.randint(0, self.noise_scheduler.config.num_train_timesteps, (batch_size,), device=device),
+            torch.randn(
+                batch_size, self.tokenizer.model_max_length, self.text_encoder.config.hidden_size, device=device,
+                requires_grad=self.config['training'].get('method', 'lora') == 'dreambooth',
+            ),
+        )
+        
+        # Capture under the run's autocast policy; the autocast weight cache must be off while capturing
+        autocast_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(self.accelerator.mixed_precision)
+        with torch.autocast("cuda", dtype=autocast_dtype, enabled=autocast_dtype is not None, cache_enabled=False):
+            self.unet_step = torch.cuda.make_graphed_callables(UNetStep(self.unet), sample_args)
+            
+        # Warmup iterations left gradients behind
+        self.optimizer.zero_grad(set_to_none=True)
+        logger.info(f"Captured UNet CUDA graphs for batch size {batch_size} at {latent_size}x{latent_size} latents")
+        
     def setup_lr_scheduler(self):
         """Setup learning rate scheduler."""
         self.lr_scheduler = get_scheduler(
@@ -390,21 +937,27 @@ class LexiGraphTrainer:
         self.setup_optimizer()
         self.setup_dataloader()
         self.setup_lr_scheduler()
+        if self.cuda_graphs:
+            self._capture_unet_graph()
 
         # Prepare everything with accelerator
         if self.config['training'].get('method', 'lora') == 'dreambooth':
-            self.unet, self.text_encoder, self.optimizer, self.train_dataloader, self.lr_scheduler = self.accelerator.prepare(
-                self.unet, self.text_encoder, self.optimizer, self.train_dataloader, self.lr_scheduler
+            self.unet, self.text_encoder, self.optimizer, self.lr_scheduler = self.accelerator.prepare(
+                self.unet, self.text_encoder, self.optimizer, self.lr_scheduler
             )
         else:
-            self.unet, self.optimizer, self.train_dataloader, self.lr_scheduler = self.accelerator.prepare(
-                self.unet, self.optimizer, self.train_dataloader, self.lr_scheduler
+            self.unet, self.optimizer, self.lr_scheduler = self.accelerator.prepare(
+                self.unet, self.optimizer, self.lr_scheduler
             )
+        # Shard streams are already independent per process; accelerate would otherwise dispatch or re-split them
+        if not isinstance(self.train_dataloader.dataset, IterableDataset):
+            self.train_dataloader = self.accelerator.prepare(self.train_dataloader)
 
         # Move vae to device
-        self.vae.to(self.accelerator.device)
-        if self.config['training'].get('method', 'lora') == 'lora':
-            self.text_encoder.to(self.accelerator.device)
+        if not self.cache_latents:
+            self.vae.to(self.accelerator.device)
+            if self.config['training'].get('method', 'lora') == 'lora':
+                self.text_encoder.to(self.accelerator.device)
 
         # Calculate total training steps
         num_update_steps_per_epoch = math.ceil(len(self.train_dataloader) / self.config['training']['gradient_accumulation_steps'])
@@ -427,6 +980,23 @@ class LexiGraphTrainer:
         if self.config['training'].get('resume_from_checkpoint'):
             self._resume_from_checkpoint()
 
+        log_every = int(self.config['logging'].get('log_every', 1))
+        
+        # Noise and timesteps are drawn from a dedicated generator in pools of `noise_pool_size` steps,
+        # so each step slices a ready buffer instead of launching its own sampling kernels
+        self.noise_gen = torch.Generator(device=self.accelerator.device)
+        if self.config['training'].get('seed') is not None:
+            self.noise_gen.manual_seed(self.config['training']['seed'] + self.accelerator.process_index)
+        else:
+            self.noise_gen.seed()
+        self._noise_pool = None
+        self._timestep_pool = None
+        self._pool_index = 0
+        
+        # Per-step loss summed on device between logging steps
+        loss_accum = torch.zeros((), device=self.accelerator.device)
+        steps_since_log = 0
+        
         progress_bar = tqdm(range(global_step, max_train_steps), disable=not self.accelerator.is_local_main_process)
         progress_bar.set_description("Steps")
 
@@ -435,28 +1005,17 @@ class LexiGraphTrainer:
             if self.config['training'].get('method', 'lora') == 'dreambooth':
                 self.text_encoder.train()
 
-            train_loss = 0.0
-
             for step, batch in enumerate(self.train_dataloader):
                 with self.accelerator.accumulate(self.unet):
-                    # Convert images to latent space
-                    latents = self.vae.encode(batch["pixel_values"]).latent_dist.sample()
-                    latents = latents * self.vae.config.scaling_factor
-
-                    # Sample noise that we'll add to the latents
-                    noise = torch.randn_like(latents)
-                    bsz = latents.shape[0]
+                    # Convert images to latent space and get the text embedding for conditioning
+                    latents, encoder_hidden_states = self._encode_batch(batch, self.train_dataset)
 
-                    # Sample a random timestep for each image
-                    timesteps = torch.randint(0, self.noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device)
-                    timesteps = timesteps.long()
+                    # Sample noise that we'll add to the latents and a random timestep for each image
+                    noise, timesteps = self._sample_noise_and_timesteps(latents)
 
                     # Add noise to the latents according to the noise magnitude at each timestep
                     noisy_latents = self.noise_scheduler.add_noise(latents, noise, timesteps)
 
-                    # Get the text embedding for conditioning
-                    encoder_hidden_states = self.text_encoder(batch["input_ids"])[0]
-
                     # Get the target for loss depending on the prediction type
                     if self.noise_scheduler.config.prediction_type == "epsilon":
                         target = noise
@@ -466,28 +1025,50 @@ class LexiGraphTrainer:
                         raise ValueError(f"Unknown prediction type {self.noise_scheduler.config.prediction_type}")
 
                     # Predict the noise residual and compute loss
-                    model_pred = self.unet(noisy_latents, timesteps, encoder_hidden_states).sample
-                    loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
+                    if self.unet_step is not None:
+                        # Inputs are copied into the captured graph's static buffers and the graph is replayed
+                        model_pred = self.unet_step(noisy_latents, timesteps, encoder_hidden_states)
+                    else:
+                        model_pred = self.unet(noisy_latents, timesteps, encoder_hidden_states).sample
+                    # Freshly encoded latents (and so the target) come out of the VAE in the autocast dtype, while the
+                    # prepared UNet returns fp32; mse_loss runs outside autocast and needs matching operand dtypes
+                    loss = F.mse_loss(model_pred, target.to(model_pred.dtype), reduction="mean")
 
-                    # Gather the losses across all processes for logging
-                    avg_loss = self.accelerator.gather(loss.repeat(self.config['training']['train_batch_size'])).mean()
-                    train_loss += avg_loss.item() / self.config['training']['gradient_accumulation_steps']
+                    # Accumulate the loss on device; it is reduced and read back once per optimizer step
+                    loss_accum += loss.detach() / self.config['training']['gradient_accumulation_steps']
 
                     # Backpropagate
                     self.accelerator.backward(loss)
-                    if self.accelerator.sync_gradients:
+                    if self.accelerator.sync_gradients and not self.optimizer_in_backward:
                         self.accelerator.clip_grad_norm_(self.unet.parameters(), self.config['training'].get('max_grad_norm', 1.0))
                         if self.config['training'].get('method', 'lora') == 'dreambooth':
                             self.accelerator.clip_grad_norm_(self.text_encoder.parameters(), self.config['training'].get('max_grad_norm', 1.0))
 
-                    self.optimizer.step()
-                    self.lr_scheduler.step()
-                    self.optimizer.zero_grad()
+                    if self.optimizer_in_backward:
+                        self.lr_scheduler.step()
+                        self._sync_in_backward_lr()
+                    else:
+                        self.optimizer.step()
+                        self.lr_scheduler.step()
+                    self.optimizer.zero_grad(set_to_none=True)
 
                 # Checks if the accelerator has performed an optimization step behind the scenes
                 if self.accelerator.sync_gradients:
                     progress_bar.update(1)
                     global_step += 1
+                    
+                    # Average the loss across processes with a single scalar all-reduce. This and the .item()
+                    # readback are the only host-device syncs, so they run on the logging cadence.
+                    steps_since_log += 1
+                    if global_step % log_every == 0 or global_step >= max_train_steps:
+                        train_loss = self.accelerator.reduce(loss_accum, reduction="mean").item() / steps_since_log
+                        self.final_loss = train_loss
+                        loss_accum.zero_()
+                        steps_since_log = 0
+                        
+                        logs = {"loss": train_loss, "lr": self.lr_scheduler.get_last_lr()[0]}
+                        progress_bar.set_postfix(**logs)
+                        self.accelerator.log(logs, step=global_step)
 
                     # Save checkpoint
                     if global_step % self.config['training'].get('checkpointing_steps', 500) == 0:
@@ -498,10 +1079,6 @@ class LexiGraphTrainer:
                     if global_step % self.config['training'].get('validation_steps', 500) == 0 and self.val_dataloader:
                         self._validate(global_step)
 
-                logs = {"loss": train_loss, "lr": self.lr_scheduler.get_last_lr()[0]}
-                progress_bar.set_postfix(**logs)
-                self.accelerator.log(logs, step=global_step)
-
                 if global_step >= max_train_steps:
                     break
 
@@ -513,6 +1090,46 @@ class LexiGraphTrainer:
         self.accelerator.end_training()
         logger.info("Training completed!")
 
+    def _sample_noise_and_timesteps(self, latents):
+        """Return noise shaped like `latents` and per-sample timesteps from the pre-sampled pools."""
+        bsz = latents.shape[0]
+        pool_size = self.config['training'].get('noise_pool_size', 64)
+        pool_batch = max(bsz, self.config['training']['train_batch_size'])
+        
+        if (
+            self._noise_pool is None
+            or self._pool_index >= pool_size
+            or self._noise_pool.shape[1] < bsz
+            or self._noise_pool.shape[2:] != latents.shape[1:]
+        ):
+            self._noise_pool = torch.randn(
+                (pool_size, pool_batch, *latents.shape[1:]),
+                generator=self.noise_gen,
+                device=latents.device,
+                dtype=latents.dtype,
+            )
+            self._timestep_pool = torch.randint(
+                0,
+                self.noise_scheduler.config.num_train_timesteps,
+                (pool_size, pool_batch),
+                generator=self.noise_gen,
+                device=latents.device,
+            )
+            self._pool_index = 0
+            
+        noise = self._noise_pool[self._pool_index, :bsz]
+        timesteps = self._timestep_pool[self._pool_index, :bsz]
+        self._pool_index += 1
+        return noise, timesteps
+        
+    def _sync_in_backward_lr(self):
+        """Copy the scheduled learning rate into the per-parameter optimizers run during backward."""
+        lr = self.lr_scheduler.get_last_lr()[0]
+        for param in self.params_to_optimize:
+            for optimizer in param._in_backward_optimizers:
+                for group in optimizer.param_groups:
+                    group['lr'] = lr
+                    
     def _save_checkpoint(self, step: int):
         """Save training checkpoint."""
         save_path = os.path.join(self.config['training']['output_dir'], f"checkpoint-{step}")
@@ -527,6 +1144,7 @@ class LexiGraphTrainer:
             # Save LoRA weights using PEFT
             try:
                 unet = self.accelerator.unwrap_model(self.unet)
+                unet = unet._orig_mod if is_compiled_module(unet) else unet
                 unet.save_pretrained(self.config['training']['output_dir'])
                 logger.info("LoRA weights saved using PEFT")
             except Exception as e:
@@ -539,6 +1157,8 @@ class LexiGraphTrainer:
         else:
             # Save full DreamBooth model
             unet = self.accelerator.unwrap_model(self.unet)
+            unet = unet._orig_mod if is_compiled_module(unet) else unet
+            unfuse_trained_projections(unet)
             text_encoder = self.accelerator.unwrap_model(self.text_encoder)
 
             pipeline = StableDiffusionPipeline.from_pretrained(
@@ -590,9 +1210,8 @@ class LexiGraphTrainer:
                 if i >= num_val_batches:
                     break
 
-                # Same forward pass as training
-                latents = self.vae.encode(batch["pixel_values"]).latent_dist.sample()
-                latents = latents * self.vae.config.scaling_factor
+                # Same forward pass as training; the validation loader is not prepared, so this also moves the batch
+                latents, encoder_hidden_states = self._encode_batch(batch, self.val_dataset)
 
                 noise = torch.randn_like(latents)
                 bsz = latents.shape[0]
@@ -600,7 +1219,6 @@ class LexiGraphTrainer:
                 timesteps = timesteps.long()
 
                 noisy_latents = self.noise_scheduler.add_noise(latents, noise, timesteps)
-                encoder_hidden_states = self.text_encoder(batch["input_ids"])[0]
 
                 if self.noise_scheduler.config.prediction_type == "epsilon":
                     target = noise
@@ -608,7 +1226,7 @@ class LexiGraphTrainer:
                     target = self.noise_scheduler.get_velocity(latents, noise, timesteps)
 
                 model_pred = self.unet(noisy_latents, timesteps, encoder_hidden_states).sample
-                loss = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
+                loss = F.mse_loss(model_pred, target.to(model_pred.dtype), reduction="mean")
                 val_loss += loss.item()
 
         val_loss /= num_val_batches